@@ -1,12 +1,54 @@
 from django.contrib import admin
-from .models import Patient, Appointment
+from .exports import record_deletions
+from .models import Patient, Appointment, ArchivedAppointment, AllAppointment
+
+
+class RecordDeletionsMixin:
+    """Deleting here removes rows from hospitals' export feeds; note it so their ETags change."""
+
+    def deleted_hospitals(self, queryset):
+        return queryset.values_list("hospital_name", flat=True)
+
+    def delete_model(self, request, obj):
+        hospitals = list(self.deleted_hospitals(type(obj).objects.filter(pk=obj.pk)))
+        super().delete_model(request, obj)
+        record_deletions(hospitals)
+
+    def delete_queryset(self, request, queryset):
+        hospitals = list(self.deleted_hospitals(queryset))
+        super().delete_queryset(request, queryset)
+        record_deletions(hospitals)
 
 @admin.register(Patient)
-class PatientAdmin(admin.ModelAdmin):
+class PatientAdmin(RecordDeletionsMixin, admin.ModelAdmin):
     list_display = ('name', 'age', 'gender', 'medical_history')
 
+    # Deleting a patient cascades to their appointments
+    def deleted_hospitals(self, queryset):
+        return AllAppointment.objects.filter(patient__in=queryset).values_list("hospital_name", flat=True)
+
 @admin.register(Appointment)
-class AppointmentAdmin(admin.ModelAdmin):
+class AppointmentAdmin(RecordDeletionsMixin, admin.ModelAdmin):
     list_display = ('patient', 'package_name', 'hospital_name', 'appointment_date', 'appointment_time', 'reference_number', 'status', 'is_recurring')
     list_filter = ('status', 'appointment_date', 'hospital_name')
     search_fields = ('patient__name', 'reference_number')
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        # Moving an appointment to another hospital removes it from the old hospital's feed
+        if change and "hospital_name" in form.changed_data:
+            record_deletions([form.initial["hospital_name"]])
+
+@admin.register(ArchivedAppointment)
+class ArchivedAppointmentAdmin(RecordDeletionsMixin, admin.ModelAdmin):
+    list_display = ('patient', 'package_name', 'hospital_name', 'appointment_date', 'appointment_time', 'reference_number', 'status', 'archived_at')
+    list_filter = ('status', 'hospital_name')
+    search_fields = ('reference_number',)
+    show_full_result_count = False # Avoid a COUNT(*) over the whole archive on every page
+
+    # The archive is written only by `manage.py archive_appointments`
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
@@ -0,0 +1,41 @@
+from django.db import transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from .models import Appointment, ArchivedAppointment
+
+ARCHIVED_FIELDS = [
+    "id", "patient_id", "package_id", "package_name", "hospital_name", "appointment_date", "appointment_time",
+    "reference_number", "idempotency_key", "status", "is_recurring", "recurrence_interval", "updated_at",
+]
+
+
+def archivable_appointments(cutoff):
+    """Appointments dated before the cutoff, or cancelled."""
+    return Appointment.objects.filter(Q(appointment_date__lt=cutoff) | Q(status='cancelled'))
+
+
+def archive_batches(cutoff, batch_size=1000):
+    """
+    Move archivable appointments into ArchivedAppointment, one transaction per
+    batch, walking the hot table in id order. Yields the number moved per batch.
+
+    Each batch is copied and deleted atomically and archived rows keep their
+    id, so the job can be stopped at any point and simply run again. A row
+    that clashes with the archive (e.g. a reused reference number) raises
+    IntegrityError and leaves its whole batch in the hot table.
+    """
+    last_id = 0
+    while True:
+        with transaction.atomic():
+            rows = list(
+                archivable_appointments(cutoff).filter(id__gt=last_id).order_by("id").values(*ARCHIVED_FIELDS)[:batch_size]
+            )
+            if not rows:
+                return
+
+            archived_at = timezone.now()
+            ArchivedAppointment.objects.bulk_create([ArchivedAppointment(archived_at=archived_at, **row) for row in rows])
+            last_id = rows[-1]["id"]
+            Appointment.objects.filter(id__in=[row["id"] for row in rows]).delete()
+        yield len(rows)
@@ -0,0 +1,96 @@
+import hashlib
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.core.cache import cache
+
+# Locks and in-flight markers live in Django's cache. The default database
+# cache (see CACHES and CacheRouter) is shared by all worker processes, and its
+# add() only succeeds for one caller, so ordering holds across workers.
+# Conversation state itself (views.user_sessions) is still per process.
+LOCK_TIMEOUT = 60 # Seconds before an abandoned lock expires on its own
+LOCK_WAIT = 15 # Seconds a request waits for its turn on a session
+POLL_INTERVAL = 0.05
+FLIGHT_RESULT_TTL = 30 # Long enough for duplicate requests to pick the result up
+IDEMPOTENCY_TTL = 60 * 60 * 24
+
+
+class SessionBusy(Exception):
+    """Raised when a request can't get its turn on a session in time."""
+
+
+@contextmanager
+def session_lock(session_id, timeout=LOCK_TIMEOUT, wait=LOCK_WAIT):
+    """
+    Serialize requests for one chat session. cache.add() only succeeds for
+    the first caller, so it doubles as a lock across processes.
+    """
+    key = f"chatbot:lock:{session_id}"
+    token = uuid.uuid4().hex
+    deadline = time.monotonic() + wait
+
+    # Poll with reads and only try add() (a write) once the lock looks free
+    while cache.get(key) is not None or not cache.add(key, token, timeout):
+        if time.monotonic() >= deadline:
+            raise SessionBusy(f"Session {session_id} is busy.")
+        time.sleep(POLL_INTERVAL)
+
+    try:
+        yield
+    finally:
+        # Only release the lock if it hasn't expired and been taken by someone else
+        if cache.get(key) == token:
+            cache.delete(key)
+
+
+def single_flight(session_id, message, func, wait=LOCK_WAIT):
+    """
+    Run func() once for identical messages in flight on the same session.
+
+    The first request (the leader) runs func() and publishes its result;
+    duplicates arriving while it runs (double-clicks, client retries) wait
+    for that result instead of repeating the work. If the leader fails
+    without a result, the duplicate runs func() itself.
+    """
+    digest = hashlib.sha256(message.encode("utf-8")).hexdigest()
+    flight_key = f"chatbot:flight:{session_id}:{digest}"
+    flight_id = uuid.uuid4().hex
+
+    if cache.add(flight_key, flight_id, LOCK_TIMEOUT):
+        try:
+            result = func()
+            cache.set(f"chatbot:flight-result:{flight_id}", result, FLIGHT_RESULT_TTL)
+            return result
+        finally:
+            cache.delete(flight_key)
+
+    leader_id = cache.get(flight_key)
+    deadline = time.monotonic() + wait
+    while leader_id is not None:
+        result = cache.get(f"chatbot:flight-result:{leader_id}")
+        if result is not None:
+            return result
+        if cache.get(flight_key) != leader_id:
+            # Leader finished; its result may have landed just before the key was cleared
+            result = cache.get(f"chatbot:flight-result:{leader_id}")
+            if result is not None:
+                return result
+            break
+        if time.monotonic() >= deadline:
+            raise SessionBusy(f"Session {session_id} is busy.")
+        time.sleep(POLL_INTERVAL)
+
+    return func()
+
+
+def idempotency_cache_key(session_id, idempotency_key):
+    return f"chatbot:idempotency:{session_id}:{idempotency_key}"
+
+
+def scoped_idempotency_key(session_id, idempotency_key):
+    """
+    The value stored in Appointment.idempotency_key. Client keys are only
+    unique per session, so the same key from another session must not match.
+    """
+    return hashlib.sha256(f"{session_id}:{idempotency_key}".encode("utf-8")).hexdigest()
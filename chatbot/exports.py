@@ -0,0 +1,209 @@
+import csv
+import hashlib
+import secrets
+from datetime import datetime, timedelta, timezone as dt_timezone
+
+from django.db.models import Q
+from django.utils.crypto import constant_time_compare
+
+from .models import AllAppointment, ExportDeletion, ExportToken
+
+PAGE_SIZE = 2000
+EXPORT_FIELDS = [
+    "id", "reference_number", "appointment_date", "appointment_time", "package_id", "package_name",
+    "patient__name", "patient__age", "patient__gender", "status", "updated_at",
+]
+CSV_HEADER = [
+    "id", "reference_number", "appointment_date", "appointment_time", "package_id", "package_name",
+    "patient_name", "patient_age", "patient_gender", "status", "updated_at",
+]
+IST = dt_timezone(timedelta(hours=5, minutes=30)) # Slot times in the catalog are IST
+CURSOR_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+ICS_LINE_OCTETS = 75
+
+
+def hash_export_token(token):
+    return hashlib.sha256(token.encode()).hexdigest()
+
+
+def issue_export_token(hospital_name):
+    """
+    Create (or replace) the random token a partner sends as
+    'Authorization: Bearer <token>'. Only its hash is stored, so the token
+    can't be shown again; reissue it if it is lost.
+    """
+    token = secrets.token_urlsafe(32)
+    ExportToken.objects.update_or_create(hospital_name=hospital_name, defaults={"token_hash": hash_export_token(token)})
+    return token
+
+
+def check_export_token(hospital_name, token):
+    """False when the token is wrong or the hospital has no token issued yet."""
+    token_hash = ExportToken.objects.filter(hospital_name=hospital_name).values_list("token_hash", flat=True).first()
+    return bool(token and token_hash) and constant_time_compare(hash_export_token(token), token_hash)
+
+
+def export_queryset(hospital_name, on_date=None):
+    # Archived appointments are still part of a hospital's history
+    queryset = AllAppointment.objects.filter(hospital_name=hospital_name)
+    if on_date:
+        queryset = queryset.filter(appointment_date=on_date)
+    return queryset
+
+
+def parse_cursor(cursor):
+    """
+    Turn an export cursor ('<updated_at in microseconds>-<id>', as sent in
+    X-Next-Cursor) into an (updated_at, id) position. Raises ValueError.
+    """
+    if not cursor:
+        return None
+    micros, _, last_id = cursor.partition("-")
+    try:
+        position = CURSOR_EPOCH + timedelta(microseconds=int(micros)), int(last_id)
+    except OverflowError:
+        position = None
+    if position is None or not 0 <= position[1] < 2 ** 63: # Ids are 64-bit integers
+        raise ValueError(f"Export cursor out of range: {cursor}")
+    return position
+
+
+def format_cursor(position):
+    if position is None:
+        return ""
+    updated_at, last_id = position
+    return f"{(updated_at - CURSOR_EPOCH) // timedelta(microseconds=1)}-{last_id}"
+
+
+def after(position):
+    updated_at, last_id = position
+    return Q(updated_at__gt=updated_at) | Q(updated_at=updated_at, id__gt=last_id)
+
+
+def record_deletions(hospital_names):
+    """Note that appointments left these hospitals' feeds, so their ETags change."""
+    for hospital_name in set(hospital_names):
+        ExportDeletion.objects.update_or_create(hospital_name=hospital_name)
+
+
+def export_snapshot(hospital_name, since=None):
+    """
+    Return (upto, etag) for the hospital's rows added or changed after the
+    `since` position. Exports stop at upto so the body matches the ETag even
+    while bookings keep changing; upto is also the cursor for the next
+    incremental pull.
+
+    Both come from index lookups, never a scan of the hospital's history:
+    upto is the hospital's newest (updated_at, id), which moves on every
+    insert or update, and deletions are covered by ExportDeletion.
+    """
+    latest = export_queryset(hospital_name).order_by("-updated_at", "-id").values_list("updated_at", "id").first()
+    upto = since if since and (latest is None or latest <= since) else latest
+    deleted_at = ExportDeletion.objects.filter(hospital_name=hospital_name).values_list("deleted_at", flat=True).first()
+    digest = hashlib.sha256(f"{format_cursor(since)}:{format_cursor(upto)}:{deleted_at}".encode()).hexdigest()[:32]
+    return upto, digest
+
+
+def iter_appointment_rows(queryset, since=None, upto=None):
+    """
+    Yield export rows in (updated_at, id) order one keyset page at a time,
+    so memory stays flat however many appointments a hospital has.
+    """
+    if upto:
+        queryset = queryset.exclude(after(upto))
+
+    position = since
+    while True:
+        if position:
+            # The rest of this timestamp, then later ones. Two queries because
+            # SQLite can only walk the index range for each half, not for the OR.
+            updated_at, last_id = position
+            parts = [queryset.filter(updated_at=updated_at, id__gt=last_id), queryset.filter(updated_at__gt=updated_at)]
+        else:
+            parts = [queryset]
+
+        rows_in_page = 0
+        for part in parts:
+            page = part.order_by("updated_at", "id").values_list(*EXPORT_FIELDS)[:PAGE_SIZE - rows_in_page]
+            for row in page.iterator(chunk_size=PAGE_SIZE):
+                rows_in_page += 1
+                position = (row[-1], row[0])
+                yield row
+            if rows_in_page == PAGE_SIZE:
+                break
+        if rows_in_page < PAGE_SIZE:
+            return
+
+
+class Echo:
+    """File-like object whose write() just returns the value, for streaming csv.writer output."""
+
+    def write(self, value):
+        return value
+
+
+def csv_cell(value):
+    # Names come from anonymous chat input; stop spreadsheets reading them as formulas
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def stream_csv(rows):
+    writer = csv.writer(Echo())
+    yield writer.writerow(CSV_HEADER)
+    for row in rows:
+        yield writer.writerow([csv_cell(value) for value in row])
+
+
+def ics_escape(text):
+    return str(text).replace("\\", "\\\\").replace(";", "\\;").replace(",", "\\,").replace("\n", "\\n")
+
+
+def ics_line(line):
+    # Fold content lines longer than 75 octets as RFC 5545 asks (continuation
+    # lines start with a space), without splitting a multi-byte character
+    if len(line.encode()) <= ICS_LINE_OCTETS:
+        return line + "\r\n"
+
+    chunks, chunk, octets = [], "", 0
+    for char in line:
+        width = len(char.encode())
+        if octets + width > ICS_LINE_OCTETS:
+            chunks.append(chunk)
+            chunk, octets = " ", 1
+        chunk += char
+        octets += width
+    chunks.append(chunk)
+    return "\r\n".join(chunks) + "\r\n"
+
+
+def stream_ics(rows, hospital_name):
+    stamp = datetime.now(dt_timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+    yield ics_line("BEGIN:VCALENDAR")
+    yield ics_line("VERSION:2.0")
+    yield ics_line("PRODID:-//Health Checkup Bot//Appointments//EN")
+    yield ics_line(f"X-WR-CALNAME:{ics_escape(hospital_name)} appointments")
+
+    for _, reference_number, appointment_date, appointment_time, _, package_name, patient_name, _, _, status, updated_at in rows:
+        try:
+            starts = datetime.combine(appointment_date, datetime.strptime(appointment_time, "%H:%M").time(), IST)
+            dtstart = f"DTSTART:{starts.astimezone(dt_timezone.utc):%Y%m%dT%H%M%SZ}"
+        except ValueError:
+            # Free-text time slot; fall back to an all-day event
+            dtstart = f"DTSTART;VALUE=DATE:{appointment_date:%Y%m%d}"
+
+        yield "".join([
+            ics_line("BEGIN:VEVENT"),
+            ics_line(f"UID:{reference_number}@health-checkup-bot"),
+            ics_line(f"DTSTAMP:{stamp}"),
+            ics_line(f"LAST-MODIFIED:{updated_at.astimezone(dt_timezone.utc):%Y%m%dT%H%M%SZ}"),
+            ics_line(dtstart),
+            ics_line(f"SUMMARY:{ics_escape(package_name)} - {ics_escape(patient_name)}"),
+            ics_line(f"DESCRIPTION:Reference number {ics_escape(reference_number)}"),
+            ics_line(f"STATUS:{'CANCELLED' if status == 'cancelled' else 'CONFIRMED'}"),
+            ics_line("END:VEVENT"),
+        ])
+
+    yield ics_line("END:VCALENDAR")
@@ -0,0 +1,208 @@
+import json
+import logging
+import os
+import queue
+import threading
+import time
+from pathlib import Path
+
+from django.conf import settings
+from django.db import IntegrityError, connection, transaction
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+FLUSH_INTERVAL = 0.2 # Seconds the writer waits for a batch to fill up
+RETRY_DELAY = 0.5 # First wait before retrying a failed batch; doubles up to MAX_RETRY_DELAY
+MAX_RETRY_DELAY = 30
+CONFLICTS_FILE = "conflicting-bookings.jsonl"
+
+
+def write_appointments(records):
+    """
+    Insert booking records in one transaction. Each record is
+    {"patient": {...Patient fields}, "appointment": {...Appointment fields}}.
+    """
+    from .models import Appointment, Patient
+
+    appointments = []
+    with transaction.atomic():
+        for record in records:
+            patient_fields = dict(record["patient"])
+            medical_history = patient_fields.pop("medical_history", "")
+            patient, created = Patient.objects.get_or_create(
+                **patient_fields,
+                defaults={'medical_history': medical_history}
+            )
+            appointments.append(Appointment(patient=patient, **record["appointment"]))
+        Appointment.objects.bulk_create(appointments)
+
+
+def already_written(references):
+    from .models import AllAppointment
+
+    # Archived bookings count too; the hot table's unique index can't see them
+    return set(AllAppointment.objects.filter(reference_number__in=list(references)).values_list("reference_number", flat=True))
+
+
+def commit_bookings(records):
+    """
+    Write journaled bookings as one batch, falling back to one at a time if
+    the batch hits a unique constraint. A booking whose reference number is
+    already in the database was written before and is skipped; any other
+    conflict is returned to the caller rather than silently dropped.
+    Returns (written, conflicts).
+    """
+    existing = already_written(record["appointment"]["reference_number"] for record in records)
+    pending = {}
+    for record in records:
+        reference_number = record["appointment"]["reference_number"]
+        if reference_number not in existing:
+            pending.setdefault(reference_number, record) # Retried confirmations share a reference number
+
+    try:
+        write_appointments(list(pending.values()))
+        return list(pending.values()), []
+    except IntegrityError:
+        pass
+
+    written, conflicts = [], []
+    for reference_number, record in pending.items():
+        try:
+            write_appointments([record])
+            written.append(record)
+        except IntegrityError:
+            if not already_written([reference_number]):
+                conflicts.append(record)
+    return written, conflicts
+
+
+def report_conflicts(directory, records):
+    """Log bookings that could not be written and keep them for manual follow-up."""
+    with open(Path(directory) / CONFLICTS_FILE, "a", encoding="utf-8") as conflicts_file:
+        for record in records:
+            logger.error("Acknowledged booking %s conflicts with an existing appointment", record["appointment"]["reference_number"])
+            conflicts_file.write(json.dumps(record, default=str) + "\n")
+
+
+class BookingJournal:
+    """
+    Durable write-behind log for appointment inserts.
+
+    submit() appends the booking to this process's journal file and fsyncs
+    it before returning, so the reference number can be handed out straight
+    away. A background thread then inserts queued bookings in batches of up
+    to BATCH_SIZE, one transaction per batch, retrying a failed batch with
+    backoff until it goes through. The file is truncated whenever every
+    journaled booking has been committed; anything left behind by a crash is
+    picked up by replay_journals().
+    """
+
+    def __init__(self, directory):
+        self.directory = Path(directory)
+        self.path = None
+        self._file = None
+        self._lock = threading.Lock()
+        self._queue = queue.Queue()
+        self._writer = None
+        self._uncommitted = 0 # Bookings in the journal file not yet in the database
+
+    def submit(self, record):
+        line = json.dumps(record, default=str) + "\n"
+        with self._lock:
+            if self._file is None:
+                # Opened on first use so every worker process gets its own file
+                self.directory.mkdir(parents=True, exist_ok=True)
+                self.path = self.directory / f"bookings-{os.getpid()}-{time.time_ns()}.jsonl"
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+
+            self._uncommitted += 1
+            self._queue.put(record)
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._run, name="booking-journal", daemon=True)
+                self._writer.start()
+        return record["appointment"]["reference_number"]
+
+    def flush(self):
+        """Block until every submitted booking has been written to the database."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + FLUSH_INTERVAL
+            while len(batch) < BATCH_SIZE:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+
+            self._commit(batch)
+
+            with self._lock:
+                self._uncommitted -= len(batch)
+                if self._uncommitted == 0:
+                    self._file.truncate(0)
+            for _ in batch:
+                self._queue.task_done()
+
+    def _commit(self, batch):
+        delay = RETRY_DELAY
+        while True:
+            try:
+                _, conflicts = commit_bookings(batch)
+                break
+            except Exception:
+                # The bookings stay in the journal file until this succeeds
+                logger.exception("Failed to write %d journaled bookings, retrying in %.1fs", len(batch), delay)
+                connection.close()
+                time.sleep(delay)
+                delay = min(delay * 2, MAX_RETRY_DELAY)
+
+        if conflicts:
+            report_conflicts(self.directory, conflicts)
+
+
+def replay_journals(directory):
+    """
+    Insert bookings from journal files left behind by stopped or crashed
+    processes, then remove the files. Bookings whose reference number is
+    already in the database are skipped, so replaying twice is harmless; any
+    other conflict is logged and kept in CONFLICTS_FILE. Returns the number
+    of bookings inserted and the number that conflicted.
+    """
+    replayed = 0
+    conflicted = 0
+    for path in sorted(Path(directory).glob("bookings-*.jsonl")):
+        records = []
+        with open(path, encoding="utf-8") as journal_file:
+            for line in journal_file:
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError:
+                    # A torn final line: the write never completed, so it was never acknowledged
+                    logger.warning("Skipping unreadable line in %s", path)
+
+        for start in range(0, len(records), BATCH_SIZE):
+            written, conflicts = commit_bookings(records[start:start + BATCH_SIZE])
+            if conflicts:
+                report_conflicts(directory, conflicts)
+            replayed += len(written)
+            conflicted += len(conflicts)
+
+        path.unlink()
+    return replayed, conflicted
+
+
+_booking_journal = None
+_booking_journal_lock = threading.Lock()
+
+def get_booking_journal():
+    global _booking_journal
+    with _booking_journal_lock:
+        if _booking_journal is None:
+            _booking_journal = BookingJournal(settings.BOOKING_JOURNAL_DIR)
+    return _booking_journal
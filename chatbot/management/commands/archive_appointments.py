@@ -0,0 +1,40 @@
+import time
+from datetime import date
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import IntegrityError
+
+from chatbot.archive import archivable_appointments, archive_batches
+
+
+class Command(BaseCommand):
+    help = (
+        "Move past and cancelled appointments out of the hot Appointment table into "
+        "ArchivedAppointment in batches. Safe to interrupt and re-run."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--before", type=date.fromisoformat, default=None, help="Archive appointments dated before this day (YYYY-MM-DD, default today)")
+        parser.add_argument("--batch-size", type=int, default=1000)
+        parser.add_argument("--dry-run", action="store_true", help="Only count what would be archived")
+
+    def handle(self, *args, **options):
+        cutoff = options["before"] or date.today()
+
+        if options["dry_run"]:
+            self.stdout.write(f"{archivable_appointments(cutoff).count()} appointment(s) would be archived.")
+            return
+
+        moved = 0
+        started = time.perf_counter()
+        try:
+            for batch_count in archive_batches(cutoff, options["batch_size"]):
+                moved += batch_count
+                if options["verbosity"] > 1:
+                    self.stdout.write(f"  archived {moved} so far")
+        except IntegrityError as e:
+            raise CommandError(f"Stopped after archiving {moved} appointment(s); the next batch conflicts with the archive and was left in place: {e}")
+        elapsed = time.perf_counter() - started
+
+        rate = f" ({moved / elapsed:,.0f} rows/s)" if moved else ""
+        self.stdout.write(self.style.SUCCESS(f"Archived {moved} appointment(s) in {elapsed:.1f}s{rate}."))
@@ -0,0 +1,73 @@
+import threading
+import time
+from datetime import date
+from tempfile import TemporaryDirectory
+
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connection
+
+from chatbot.journal import BookingJournal, write_appointments
+from chatbot.models import Appointment, Patient
+
+BENCH_PREFIX = "BENCH"
+
+
+class Command(BaseCommand):
+    help = "Measure appointment insert throughput with N concurrent writers."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--writers", type=int, default=8)
+        parser.add_argument("--bookings", type=int, default=100, help="Bookings per writer")
+        parser.add_argument("--write-behind", action="store_true", help="Go through the booking journal")
+
+    def handle(self, *args, **options):
+        writers = options["writers"]
+        per_writer = options["bookings"]
+        errors = []
+
+        with TemporaryDirectory() as journal_dir:
+            journal = BookingJournal(journal_dir) if options["write_behind"] else None
+
+            def writer(writer_index):
+                try:
+                    for i in range(per_writer):
+                        booking = {
+                            "patient": {"name": f"{BENCH_PREFIX} patient {writer_index}", "age": 40, "gender": "female", "medical_history": ""},
+                            "appointment": {
+                                "package_id": "PKG003",
+                                "package_name": "Basic Checkup",
+                                "hospital_name": "City General Hospital",
+                                "appointment_date": date.today(),
+                                "appointment_time": "09:00",
+                                "reference_number": f"{BENCH_PREFIX}{writer_index:04d}{i:06d}",
+                            },
+                        }
+                        try:
+                            if journal:
+                                journal.submit(booking)
+                            else:
+                                write_appointments([booking])
+                        except OperationalError as e:
+                            errors.append(str(e))
+                finally:
+                    connection.close()
+
+            threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+            started = time.perf_counter()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            acknowledged = time.perf_counter() - started
+            if journal:
+                journal.flush()
+            committed = time.perf_counter() - started
+
+        total = writers * per_writer
+        self.stdout.write(f"{writers} writers x {per_writer} bookings ({'write-behind' if journal else 'synchronous'})")
+        self.stdout.write(f"  acknowledged: {total / acknowledged:,.0f} bookings/s ({acknowledged:.2f}s)")
+        self.stdout.write(f"  committed:    {total / committed:,.0f} bookings/s ({committed:.2f}s)")
+        self.stdout.write(f"  errors:       {len(errors)}" + (f" (first: {errors[0]})" if errors else ""))
+
+        Appointment.objects.filter(reference_number__startswith=BENCH_PREFIX).delete()
+        Patient.objects.filter(name__startswith=BENCH_PREFIX).delete()
@@ -0,0 +1,53 @@
+import io
+import json
+import pstats
+from pathlib import Path
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chatbot.profiling import PROFILE_HEADER, make_profile_token
+
+
+class Command(BaseCommand):
+    help = "List and summarize request profiles captured from the chat API, or issue a profiling token."
+
+    def add_arguments(self, parser):
+        subparsers = parser.add_subparsers(dest="action", required=True)
+        subparsers.add_parser("list", help="List captured profiles, newest first")
+        show = subparsers.add_parser("show", help="Print the top functions of one profile")
+        show.add_argument("profile_id")
+        show.add_argument("--sort", default="cumulative", help="pstats sort key (cumulative, tottime, ncalls...)")
+        show.add_argument("--limit", type=int, default=25)
+        subparsers.add_parser("token", help=f"Print a signed {PROFILE_HEADER} header value")
+
+    def handle(self, *args, **options):
+        profile_dir = Path(settings.CHATBOT_PROFILE_DIR)
+
+        if options["action"] == "token":
+            if not settings.CHATBOT_SIGNING_KEY:
+                raise CommandError("Set CHATBOT_SIGNING_KEY to issue profiling tokens.")
+            self.stdout.write(f"{PROFILE_HEADER}: {make_profile_token()}")
+
+        elif options["action"] == "list":
+            profiles = sorted(profile_dir.glob("*.prof"), reverse=True)
+            if not profiles:
+                self.stdout.write(f"No profiles in {profile_dir}.")
+            for profile in profiles:
+                meta_path = profile.with_suffix(".json")
+                meta = json.loads(meta_path.read_text()) if meta_path.exists() else {}
+                self.stdout.write(
+                    f"{profile.stem}  {meta.get('trigger', '?'):6}  status={meta.get('status', '?')}  "
+                    f"elapsed={meta.get('elapsed', 0):.3f}s  "
+                    f"queries={meta.get('queries', '?')} ({meta.get('query_time', 0):.3f}s)"
+                )
+
+        else:
+            profile = profile_dir / f"{options['profile_id']}.prof"
+            if not profile.exists():
+                raise CommandError(f"No profile named {options['profile_id']} in {profile_dir}.")
+            # pstats writes in fragments, so collect its output before handing it to self.stdout
+            output = io.StringIO()
+            stats = pstats.Stats(str(profile), stream=output)
+            stats.strip_dirs().sort_stats(options["sort"]).print_stats(options["limit"])
+            self.stdout.write(output.getvalue())
@@ -0,0 +1,47 @@
+import sys
+from datetime import date
+
+from django.core.management.base import BaseCommand
+
+from chatbot.exports import export_queryset, export_snapshot, format_cursor, issue_export_token, iter_appointment_rows, parse_cursor, stream_csv, stream_ics
+
+
+class Command(BaseCommand):
+    help = "Stream one hospital's appointments as CSV or iCalendar, or issue its export API token."
+
+    def add_arguments(self, parser):
+        parser.add_argument("hospital_name")
+        parser.add_argument("--format", choices=["csv", "ics"], default="csv")
+        parser.add_argument("--date", type=date.fromisoformat, default=None, help="Only appointments on this day (YYYY-MM-DD)")
+        parser.add_argument(
+            "--since", type=parse_cursor, default=None,
+            help="Cursor from a previous export; only bookings added or changed since are included",
+        )
+        parser.add_argument("--output", help="File to write to (default stdout)")
+        parser.add_argument(
+            "--issue-token", action="store_true",
+            help="Issue a new export API token for the hospital (revoking any previous one), print it once and exit",
+        )
+
+    def handle(self, *args, **options):
+        hospital_name = options["hospital_name"]
+        if options["issue_token"]:
+            self.stdout.write(issue_export_token(hospital_name))
+            return
+
+        queryset = export_queryset(hospital_name, options["date"])
+        upto, _ = export_snapshot(hospital_name, options["since"])
+        rows = iter_appointment_rows(queryset, options["since"], upto)
+        chunks = stream_ics(rows, hospital_name) if options["format"] == "ics" else stream_csv(rows)
+
+        newline = "" # Chunks already carry their own line endings
+        output = open(options["output"], "w", encoding="utf-8", newline=newline) if options["output"] else sys.stdout
+        try:
+            for chunk in chunks:
+                output.write(chunk)
+        finally:
+            if options["output"]:
+                output.close()
+
+        # Cursor goes to stderr so stdout stays a clean feed
+        self.stderr.write(f"Next cursor: {format_cursor(upto)}")
@@ -0,0 +1,20 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chatbot.journal import CONFLICTS_FILE, replay_journals
+
+
+class Command(BaseCommand):
+    help = (
+        "Insert bookings left in the write-behind journal by a stopped or crashed "
+        "server. Run this before starting the workers, not while they are serving."
+    )
+
+    def handle(self, *args, **options):
+        replayed, conflicted = replay_journals(settings.BOOKING_JOURNAL_DIR)
+        self.stdout.write(self.style.SUCCESS(f"Replayed {replayed} journaled booking(s)."))
+        if conflicted:
+            self.stderr.write(self.style.ERROR(
+                f"{conflicted} booking(s) conflicted with existing appointments; "
+                f"see {settings.BOOKING_JOURNAL_DIR / CONFLICTS_FILE}."
+            ))
@@ -0,0 +1,50 @@
+import random
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+
+from chatbot.models import Appointment, Patient
+
+SEED_PREFIX = "SEED"
+
+
+class Command(BaseCommand):
+    help = "Fill the Appointment table with synthetic rows, for benchmarking archival and exports."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--count", type=int, default=1_000_000)
+        parser.add_argument("--batch-size", type=int, default=5000)
+        parser.add_argument("--days", type=int, default=730, help="Spread appointments over this many days around today")
+        parser.add_argument("--delete", action="store_true", help="Remove previously seeded rows instead")
+
+    def handle(self, *args, **options):
+        if options["delete"]:
+            Appointment.objects.filter(reference_number__startswith=SEED_PREFIX).delete()
+            Patient.objects.filter(name__startswith=SEED_PREFIX).delete()
+            return
+
+        patients = Patient.objects.bulk_create(
+            [Patient(name=f"{SEED_PREFIX} patient {i}", age=random.randint(18, 80), gender=random.choice(["male", "female"])) for i in range(1000)]
+        )
+        hospitals = ["City General Hospital", "Apex Medical", "Sunrise Hospital", "Metro Health Center"]
+        first_day = date.today() - timedelta(days=options["days"] // 2)
+        started = time.perf_counter()
+        offset = Appointment.objects.filter(reference_number__startswith=SEED_PREFIX).count()
+
+        for start in range(0, options["count"], options["batch_size"]):
+            Appointment.objects.bulk_create([
+                Appointment(
+                    patient=random.choice(patients),
+                    package_id="PKG003",
+                    package_name="Basic Checkup",
+                    hospital_name=random.choice(hospitals),
+                    appointment_date=first_day + timedelta(days=random.randrange(options["days"])),
+                    appointment_time="09:00",
+                    reference_number=f"{SEED_PREFIX}{offset + i:012d}",
+                    status="cancelled" if random.random() < 0.05 else "confirmed",
+                )
+                for i in range(start, min(start + options["batch_size"], options["count"]))
+            ])
+
+        self.stdout.write(f"Seeded {options['count']} appointment(s) in {time.perf_counter() - started:.1f}s.")
@@ -0,0 +1,50 @@
+import re
+
+from django.middleware.gzip import GZipMiddleware
+from django.utils.cache import patch_vary_headers
+
+try:
+    import brotli
+except ImportError:  # brotli is optional; fall back to plain gzip
+    brotli = None
+
+re_accepts_brotli = re.compile(r"\bbr\b")
+
+
+class CompressionMiddleware(GZipMiddleware):
+    """
+    Compress JSON API responses with brotli when the client accepts it and
+    the `brotli` package is installed. Everything else, including HTML pages
+    that carry CSRF tokens, goes through Django's gzip handling, which pads
+    the output against BREACH.
+    """
+
+    def process_response(self, request, response):
+        if (
+            brotli is None
+            or not response.get("Content-Type", "").startswith("application/json")
+            or response.streaming
+            or response.has_header("Content-Encoding")
+            or len(response.content) < 200
+            or not re_accepts_brotli.search(request.META.get("HTTP_ACCEPT_ENCODING", ""))
+        ):
+            return super().process_response(request, response)
+
+        patch_vary_headers(response, ("Accept-Encoding",))
+
+        compressed_content = brotli.compress(response.content)
+        # Return the uncompressed body if compression doesn't save space
+        if len(compressed_content) >= len(response.content):
+            return response
+
+        response.content = compressed_content
+        response.headers["Content-Length"] = str(len(response.content))
+
+        # Same reasoning as GZipMiddleware: the encoded body is no longer
+        # byte-identical to the original, so a strong ETag must be weakened.
+        etag = response.get("ETag")
+        if etag and etag.startswith('"'):
+            response.headers["ETag"] = "W/" + etag
+
+        response.headers["Content-Encoding"] = "br"
+        return response
@@ -0,0 +1,114 @@
+# Generated by Django 5.2.18 on 2026-10-19 08:29
+
+import django.db.models.deletion
+from django.core.management import call_command
+from django.db import migrations, models
+
+APPOINTMENT_COLUMNS = (
+    "id, patient_id, package_id, package_name, hospital_name, appointment_date, appointment_time, "
+    "reference_number, idempotency_key, status, is_recurring, recurrence_interval, updated_at"
+)
+
+
+def create_cache_tables(apps, schema_editor):
+    # Creates the table for every DatabaseCache in settings.CACHES; existing tables are left alone
+    call_command("createcachetable", database=schema_editor.connection.alias, verbosity=0)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chatbot', '0002_appointment_idempotency_key'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AllAppointment',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('package_id', models.CharField(max_length=50)),
+                ('package_name', models.CharField(max_length=255)),
+                ('hospital_name', models.CharField(max_length=255)),
+                ('appointment_date', models.DateField()),
+                ('appointment_time', models.CharField(max_length=50)),
+                ('reference_number', models.CharField(max_length=100, unique=True)),
+                ('idempotency_key', models.CharField(blank=True, max_length=100, null=True, unique=True)),
+                ('status', models.CharField(default='confirmed', max_length=50)),
+                ('is_recurring', models.BooleanField(default=False)),
+                ('recurrence_interval', models.CharField(blank=True, max_length=50, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+                ('is_archived', models.BooleanField()),
+            ],
+            options={
+                'db_table': 'chatbot_all_appointments',
+                'managed': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='ArchivedAppointment',
+            fields=[
+                ('package_id', models.CharField(max_length=50)),
+                ('package_name', models.CharField(max_length=255)),
+                ('hospital_name', models.CharField(max_length=255)),
+                ('appointment_date', models.DateField()),
+                ('appointment_time', models.CharField(max_length=50)),
+                ('reference_number', models.CharField(max_length=100, unique=True)),
+                ('idempotency_key', models.CharField(blank=True, max_length=100, null=True, unique=True)),
+                ('status', models.CharField(default='confirmed', max_length=50)),
+                ('is_recurring', models.BooleanField(default=False)),
+                ('recurrence_interval', models.CharField(blank=True, max_length=50, null=True)),
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ExportDeletion',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hospital_name', models.CharField(max_length=255, unique=True)),
+                ('deleted_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='ExportToken',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('hospital_name', models.CharField(max_length=255, unique=True)),
+                ('token_hash', models.CharField(max_length=64)),
+                ('issued_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='appointment',
+            name='updated_at',
+            field=models.DateTimeField(auto_now=True),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['appointment_date'], name='chatbot_app_appoint_e4318b_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['hospital_name', 'updated_at', 'id'], name='chatbot_app_hospita_3bf4d3_idx'),
+        ),
+        migrations.AddField(
+            model_name='archivedappointment',
+            name='patient',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chatbot.patient'),
+        ),
+        migrations.AddIndex(
+            model_name='archivedappointment',
+            index=models.Index(fields=['hospital_name', 'updated_at', 'id'], name='chatbot_arc_hospita_2ef2ad_idx'),
+        ),
+        migrations.RunSQL(
+            sql=(
+                "CREATE VIEW chatbot_all_appointments AS "
+                f"SELECT {APPOINTMENT_COLUMNS}, FALSE AS is_archived FROM chatbot_appointment "
+                "UNION ALL "
+                f"SELECT {APPOINTMENT_COLUMNS}, TRUE AS is_archived FROM chatbot_archivedappointment"
+            ),
+            reverse_sql="DROP VIEW chatbot_all_appointments",
+        ),
+        migrations.RunPython(create_cache_tables, migrations.RunPython.noop, hints={"cache_tables": True}), # Only runs on the cache database
+    ]
@@ -9,7 +9,7 @@ class Patient(models.Model):
     def __str__(self):
         return self.name
 
-class Appointment(models.Model):
+class AppointmentBase(models.Model):
     patient = models.ForeignKey(Patient, on_delete=models.CASCADE)
     package_id = models.CharField(max_length=50) # From CSV
     package_name = models.CharField(max_length=255) # From CSV
@@ -17,11 +17,65 @@ class Appointment(models.Model):
     appointment_date = models.DateField()
     appointment_time = models.CharField(max_length=50) # Or TimeField
     reference_number = models.CharField(max_length=100, unique=True)
+    idempotency_key = models.CharField(max_length=100, unique=True, blank=True, null=True) # Hash of session + client-supplied key, dedupes retried confirmations
     status = models.CharField(max_length=50, default='confirmed') # e.g., 'confirmed', 'cancelled'
     is_recurring = models.BooleanField(default=False)
     recurrence_interval = models.CharField(max_length=50, blank=True, null=True) # e.g., '6 months', '1 year'
-    
+    updated_at = models.DateTimeField(auto_now=True) # Export cursors and ETags use this to pick up changes like cancellations
+
+    class Meta:
+        abstract = True
+
     def __str__(self):
         return f"Appointment for {self.patient.name} - {self.package_name} on {self.appointment_date}"
 
+class Appointment(AppointmentBase):
+    # Upcoming appointments only; past and cancelled ones are moved to
+    # ArchivedAppointment by `manage.py archive_appointments`
+    class Meta:
+        indexes = [
+            models.Index(fields=['appointment_date']),
+            models.Index(fields=['hospital_name', 'updated_at', 'id']), # Keyset pagination for per-hospital exports
+        ]
+
+class ArchivedAppointment(AppointmentBase):
+    id = models.BigIntegerField(primary_key=True) # Same id the row had in Appointment
+    updated_at = models.DateTimeField() # Copied from Appointment, so archiving doesn't look like a change to exports
+    archived_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['hospital_name', 'updated_at', 'id']),
+        ]
+
+class AllAppointment(AppointmentBase):
+    """Read-only view over Appointment and ArchivedAppointment, for reporting."""
+    patient = models.ForeignKey(Patient, on_delete=models.DO_NOTHING) # Rows go away with the underlying tables
+    is_archived = models.BooleanField()
+
+    class Meta:
+        managed = False
+        db_table = 'chatbot_all_appointments'
+
+class ExportToken(models.Model):
+    """Per-hospital API token for the appointment export feed; only its SHA-256 is stored."""
+    hospital_name = models.CharField(max_length=255, unique=True)
+    token_hash = models.CharField(max_length=64)
+    issued_at = models.DateTimeField(auto_now=True) # Reissuing a token replaces the old one
+
+    def __str__(self):
+        return f"Export token for {self.hospital_name}"
+
+class ExportDeletion(models.Model):
+    """
+    When appointments last left a hospital's export feed (deleted, or moved
+    to another hospital). Export ETags include it, since a removed row
+    doesn't change the feed's newest (updated_at, id).
+    """
+    hospital_name = models.CharField(max_length=255, unique=True)
+    deleted_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return f"Last deletion from {self.hospital_name}"
+
 # Create your models here.
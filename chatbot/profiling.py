@@ -0,0 +1,126 @@
+import cProfile
+import functools
+import json
+import logging
+import random
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+
+from django.conf import settings
+from django.core import signing
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+PROFILE_HEADER = "X-Chatbot-Profile"
+PROFILE_SALT = "chatbot.profile"
+PROFILE_TOKEN_MAX_AGE = 60 * 60 # Seconds a signed profiling token stays valid
+
+# cProfile can only run one profiler per process at a time
+_profiler_lock = threading.Lock()
+
+
+def profile_signer():
+    # SECRET_KEY is committed to the repo, so profiling tokens need their own key
+    if not settings.CHATBOT_SIGNING_KEY:
+        return None
+    return signing.TimestampSigner(key=settings.CHATBOT_SIGNING_KEY, salt=PROFILE_SALT)
+
+
+def make_profile_token():
+    """Signed value for the X-Chatbot-Profile header that forces profiling of a request."""
+    return profile_signer().sign("profile")
+
+
+def profile_trigger(request):
+    token = request.headers.get(PROFILE_HEADER)
+    signer = profile_signer()
+    if token and signer:
+        try:
+            signer.unsign(token, max_age=PROFILE_TOKEN_MAX_AGE)
+            return "header"
+        except signing.BadSignature:
+            pass
+
+    sample_rate = settings.CHATBOT_PROFILE_SAMPLE_RATE
+    if sample_rate > 0 and random.randrange(sample_rate) == 0:
+        return "sample"
+    return None
+
+
+def profile_request(view):
+    """
+    Profile a view with cProfile when the request carries a valid signed
+    X-Chatbot-Profile header, or for 1 in CHATBOT_PROFILE_SAMPLE_RATE requests.
+
+    Each capture is written to CHATBOT_PROFILE_DIR as a .prof file (readable
+    with pstats) plus a .json file with timing and ORM query stats. Only the
+    newest CHATBOT_PROFILE_KEEP captures are kept.
+    """
+    @functools.wraps(view)
+    def wrapper(request, *args, **kwargs):
+        trigger = profile_trigger(request)
+        if not trigger or not _profiler_lock.acquire(blocking=False):
+            return view(request, *args, **kwargs)
+
+        queries = {"count": 0, "time": 0.0}
+
+        def time_query(execute, sql, params, many, context):
+            started = time.perf_counter()
+            try:
+                return execute(sql, params, many, context)
+            finally:
+                queries["count"] += 1
+                queries["time"] += time.perf_counter() - started
+
+        profiler = cProfile.Profile()
+        started = time.perf_counter()
+        try:
+            with connection.execute_wrapper(time_query):
+                profiler.enable()
+                try:
+                    response = view(request, *args, **kwargs)
+                finally:
+                    profiler.disable()
+            elapsed = time.perf_counter() - started
+
+            # A full disk or unwritable profile dir must not turn a good reply into a 500
+            try:
+                profile_id = save_profile(profiler, {
+                    "path": request.path,
+                    "trigger": trigger,
+                    "status": response.status_code,
+                    "elapsed": elapsed,
+                    "queries": queries["count"],
+                    "query_time": queries["time"],
+                })
+            except OSError:
+                logger.exception("Failed to save request profile for %s", request.path)
+                return response
+        finally:
+            _profiler_lock.release()
+
+        response["X-Chatbot-Profile-Id"] = profile_id
+        return response
+
+    return wrapper
+
+
+def save_profile(profiler, meta):
+    profile_dir = Path(settings.CHATBOT_PROFILE_DIR)
+    profile_dir.mkdir(parents=True, exist_ok=True)
+    profile_id = f"{datetime.now():%Y%m%d-%H%M%S-%f}-{int(meta['elapsed'] * 1000)}ms"
+    profiler.dump_stats(profile_dir / f"{profile_id}.prof")
+    with open(profile_dir / f"{profile_id}.json", "w", encoding="utf-8") as meta_file:
+        json.dump(meta, meta_file)
+    rotate_profiles(profile_dir, settings.CHATBOT_PROFILE_KEEP)
+    return profile_id
+
+
+def rotate_profiles(profile_dir, keep):
+    profiles = sorted(Path(profile_dir).glob("*.prof"))
+    for old_profile in profiles[:-keep]:
+        old_profile.unlink(missing_ok=True)
+        old_profile.with_suffix(".json").unlink(missing_ok=True)
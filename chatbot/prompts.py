@@ -0,0 +1,79 @@
+import logging
+import math
+
+from .ratelimit import llm_state
+
+logger = logging.getLogger(__name__)
+
+CHARS_PER_TOKEN = 4 # Rough estimate for English text; good enough for budgeting
+
+# One entry per place we call Gemini. max_input_tokens caps the whole prompt;
+# the user's message is truncated to whatever the template leaves free.
+PROMPTS = {
+    "follow_up": {
+        "template": "Extract the follow-up interval (e.g. 6 months, 1 year) from: '{message}'",
+        "max_input_tokens": 120,
+        "max_output_tokens": 24,
+    },
+    "collect_details": {
+        "template": (
+            "From the following text, extract the Name, Age, Gender, and Medical History. "
+            "Format your output as a markdown list, like: '* **Name:** [name]\\n* **Age:** [age]...'. "
+            "If any piece of information is missing, use 'N/A' for that specific field.\n"
+            "Text: '{message}'"
+        ),
+        "max_input_tokens": 300,
+        "max_output_tokens": 120,
+    },
+    "select_alternative": {
+        "template": (
+            "Options:\n{options}\n"
+            "Which option number does the user pick? Reply with the number only, or N/A.\n"
+            "User: '{message}'"
+        ),
+        "max_input_tokens": 250,
+        "max_output_tokens": 8,
+    },
+}
+
+
+def estimate_tokens(text):
+    return math.ceil(len(text) / CHARS_PER_TOKEN)
+
+
+def render_prompt(call_site, message, **context):
+    """Fill in a prompt template, truncating the message to fit the call site's token budget."""
+    template = PROMPTS[call_site]["template"]
+    fixed_tokens = estimate_tokens(template.format(message="", **context))
+    message_budget = max(0, PROMPTS[call_site]["max_input_tokens"] - fixed_tokens) * CHARS_PER_TOKEN
+    if len(message) > message_budget:
+        message = message[:message_budget]
+    return template.format(message=message, **context)
+
+
+def format_slot_options(alternatives):
+    """Number the alternative slots as short one-line codes, e.g. '1. Apex Medical 2025-09-01 09:30'."""
+    return "\n".join(
+        f"{i}. {alt['hospital_name']} {alt['appointment_date']} {alt['time_slot']}"
+        for i, alt in enumerate(alternatives, start=1)
+    )
+
+
+def record_usage(usage, call_site, input_tokens, output_tokens, latency):
+    """Add one call to the per-call-site usage totals and return them."""
+    totals = usage.get(call_site) or {"calls": 0, "input_tokens": 0, "output_tokens": 0, "latency": 0.0}
+    logger.info("LLM call %s: %d input / %d output tokens in %.2fs", call_site, input_tokens, output_tokens, latency)
+    return {
+        **usage,
+        call_site: {
+            "calls": totals["calls"] + 1,
+            "input_tokens": totals["input_tokens"] + input_tokens,
+            "output_tokens": totals["output_tokens"] + output_tokens,
+            "latency": totals["latency"] + latency,
+        },
+    }
+
+
+def usage_by_call_site():
+    usage = llm_state()["usage"]
+    return {call_site: usage.get(call_site) for call_site in PROMPTS}
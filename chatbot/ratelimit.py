@@ -0,0 +1,185 @@
+import logging
+import time
+import uuid
+from contextlib import contextmanager
+
+from django.core.cache import caches
+
+logger = logging.getLogger(__name__)
+
+# Limiter buckets and load/usage metrics have their own cache alias (see
+# CACHES in settings), shared by all workers and kept apart from the
+# per-message idempotency records so those can't cull them.
+limits_cache = caches["ratelimit"]
+
+# Token bucket limits as (tokens refilled per second, burst size)
+IP_LIMIT = (3.0, 30)
+SESSION_LIMIT = (1.0, 10)
+LLM_SESSION_LIMIT = (0.2, 5) # Messages that will reach Gemini, per session
+
+# Load shedding: refuse new LLM work while Gemini is backed up
+MAX_LLM_IN_FLIGHT = 8
+LLM_CALL_TIMEOUT = 120 # Seconds after which an in-flight call is presumed dead (e.g. worker killed)
+LLM_P95_THRESHOLD = 10.0 # Seconds
+LATENCY_WINDOW = 300 # Only calls that finished in the last this-many seconds count towards the p95
+MAX_LATENCY_SAMPLES = 500
+MIN_LATENCY_SAMPLES = 20
+PROBE_INTERVAL = 10 # While shedding on latency, let one LLM request through this often
+SHED_RETRY_AFTER = 5
+
+# In-flight calls, recent latencies and token usage share one key, so each
+# LLM call costs a single state update when it starts and one when it ends
+LLM_STATE_KEY = "chatbot:llm:state"
+LLM_PROBE_KEY = "chatbot:llm:probe"
+REJECTION_REASONS = ("ip", "session", "llm", "llm_in_flight", "llm_latency")
+
+
+class Throttled(Exception):
+    """Raised when a request is rate limited (429) or shed under load (503)."""
+
+    def __init__(self, reason, status, retry_after):
+        super().__init__(reason)
+        self.reason = reason
+        self.status = status
+        self.retry_after = retry_after
+
+
+def take_token(name, rate, burst):
+    """
+    Take one token from the named bucket. Returns 0 on success, otherwise the
+    number of seconds until a token will be available. The read-modify-write
+    isn't atomic, so concurrent requests may occasionally overdraw by one.
+    """
+    key = f"chatbot:bucket:{name}"
+    now = time.time()
+    tokens, updated = limits_cache.get(key, (burst, now))
+    tokens = min(burst, tokens + (now - updated) * rate)
+    ttl = int(burst / rate) + 60
+
+    if tokens < 1:
+        limits_cache.set(key, (tokens, now), ttl)
+        return (1 - tokens) / rate
+
+    limits_cache.set(key, (tokens - 1, now), ttl)
+    return 0
+
+
+def check_rate_limits(ip_address, session_id, calls_llm):
+    """Raise Throttled if this request is over budget or the LLM is overloaded."""
+    wait = take_token(f"ip:{ip_address}", *IP_LIMIT)
+    if wait:
+        reject("ip", 429, wait)
+
+    wait = take_token(f"session:{session_id}", *SESSION_LIMIT)
+    if wait:
+        reject("session", 429, wait)
+
+    if not calls_llm:
+        return
+
+    if llm_in_flight() >= MAX_LLM_IN_FLIGHT:
+        reject("llm_in_flight", 503, SHED_RETRY_AFTER)
+
+    p95 = llm_p95_latency()
+    # Shed requests add no latency samples, so let an occasional probe through
+    # to find out when Gemini has recovered
+    if p95 is not None and p95 > LLM_P95_THRESHOLD and not limits_cache.add(LLM_PROBE_KEY, True, PROBE_INTERVAL):
+        reject("llm_latency", 503, SHED_RETRY_AFTER)
+
+    wait = take_token(f"llm:{session_id}", *LLM_SESSION_LIMIT)
+    if wait:
+        reject("llm", 429, wait)
+
+
+@contextmanager
+def state_lock(key, timeout=5, wait=1.0):
+    """
+    Short best-effort lock around a read-modify-write of shared limiter state.
+    If it can't be had within `wait` seconds the update goes ahead unlocked;
+    losing a sample is better than stalling a request.
+    """
+    lock_key = f"{key}:lock"
+    deadline = time.monotonic() + wait
+    while not limits_cache.add(lock_key, True, timeout):
+        if time.monotonic() >= deadline:
+            yield
+            return
+        time.sleep(0.01)
+    try:
+        yield
+    finally:
+        limits_cache.delete(lock_key)
+
+
+def update_state(key, func):
+    with state_lock(key):
+        value = func(limits_cache.get(key))
+        limits_cache.set(key, value, None)
+    return value
+
+
+def reject(reason, status, retry_after):
+    update_state(f"chatbot:rejected:{reason}", lambda count: (count or 0) + 1)
+    logger.warning("Rejected chat request (%s), retry after %.1fs", reason, retry_after)
+    raise Throttled(reason, status, retry_after)
+
+
+def rejection_counts():
+    return {reason: limits_cache.get(f"chatbot:rejected:{reason}", 0) for reason in REJECTION_REASONS}
+
+
+def live_calls(calls, now):
+    # Drop calls that have been "in flight" too long; their worker has most likely died
+    return {call_id: started for call_id, started in (calls or {}).items() if started > now - LLM_CALL_TIMEOUT}
+
+
+def recent_latencies(samples, now):
+    return [(finished, latency) for finished, latency in (samples or []) if finished > now - LATENCY_WINDOW]
+
+
+def llm_state():
+    return limits_cache.get(LLM_STATE_KEY) or {"calls": {}, "latencies": [], "usage": {}}
+
+
+@contextmanager
+def track_llm_call():
+    """
+    Count an LLM call as in flight and record its latency once it returns.
+
+    Yields a dict; a caller that sets call["record_usage"] to a function
+    (usage, latency) -> usage has it applied to the usage totals in the same
+    update that ends the call.
+    """
+    call_id = uuid.uuid4().hex
+    started = time.time()
+    call = {}
+
+    def start(state):
+        state = state or llm_state()
+        return {**state, "calls": {**live_calls(state["calls"], started), call_id: started}}
+
+    def finish(state):
+        state = state or llm_state()
+        latency = finished - started
+        calls = {k: v for k, v in live_calls(state["calls"], finished).items() if k != call_id}
+        latencies = (recent_latencies(state["latencies"], finished) + [(finished, latency)])[-MAX_LATENCY_SAMPLES:]
+        usage = call["record_usage"](state["usage"], latency) if "record_usage" in call else state["usage"]
+        return {"calls": calls, "latencies": latencies, "usage": usage}
+
+    update_state(LLM_STATE_KEY, start)
+    try:
+        yield call
+    finally:
+        finished = time.time()
+        update_state(LLM_STATE_KEY, finish)
+
+
+def llm_in_flight():
+    return len(live_calls(llm_state()["calls"], time.time()))
+
+
+def llm_p95_latency():
+    latencies = sorted(latency for _, latency in recent_latencies(llm_state()["latencies"], time.time()))
+    if len(latencies) < MIN_LATENCY_SAMPLES:
+        return None
+    return latencies[int(0.95 * (len(latencies) - 1))]
@@ -0,0 +1,24 @@
+CACHE_DATABASE = "cache"
+
+
+class CacheRouter:
+    """
+    Keep the DatabaseCache tables (Django gives them the app label
+    'django_cache') in their own SQLite file. Lock polling and limiter
+    updates write on nearly every request, and in the project database each
+    of those writes would queue for the same write lock as the bookings.
+    """
+
+    def db_for_read(self, model, **hints):
+        if model._meta.app_label == "django_cache":
+            return CACHE_DATABASE
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if app_label == "django_cache" or hints.get("cache_tables"):
+            return db == CACHE_DATABASE
+        if db == CACHE_DATABASE:
+            return False # Nothing else belongs in the cache database
+        return None
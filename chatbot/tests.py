@@ -1,3 +1,505 @@
-from django.test import TestCase
+import json
+import shutil
+import tempfile
+import time
+from datetime import date
+from pathlib import Path
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import admin
+from django.core.cache import cache
+from django.db import IntegrityError, OperationalError
+from django.http import HttpResponse, JsonResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, override_settings
+
+from . import ratelimit, views
+from .admin import AppointmentAdmin
+from .archive import archive_batches
+from .exports import ics_line, issue_export_token, stream_csv
+from .journal import CONFLICTS_FILE, BookingJournal, replay_journals, write_appointments
+from .middleware import CompressionMiddleware
+from .models import AllAppointment, Appointment, ArchivedAppointment, Patient
+from .profiling import PROFILE_HEADER, profile_trigger
+from .prompts import PROMPTS, estimate_tokens, format_slot_options, record_usage, render_prompt, usage_by_call_site
+from .ratelimit import limits_cache
+
+CHAT_URL = "/api/chat/"
+
+
+class ConfirmationIdempotencyTests(TestCase):
+    databases = {"default", "cache"}
+
+    def setUp(self):
+        cache.clear()
+        views.user_sessions.clear()
+
+    def start_confirmation(self, client):
+        # The first message creates the Django session; then jump straight to the confirm step
+        client.post(CHAT_URL, {"message": "hi"}, content_type="application/json")
+        views.user_sessions[client.session.session_key] = {
+            "state": "confirm_slot",
+            "patient_data": {
+                "name": "Jane Doe",
+                "age": 45,
+                "gender": "female",
+                "medical_history": "",
+                "recommended_package_id": "PKG003",
+                "recommended_package_name": "Basic Checkup",
+                "selected_hospital": "City General Hospital",
+                "preferred_date": date(2025, 10, 1),
+                "selected_time_slot": "09:00",
+            },
+        }
+
+    def confirm(self, client, key):
+        response = client.post(CHAT_URL, {"message": "yes"}, content_type="application/json", headers={"Idempotency-Key": key})
+        self.assertEqual(response.status_code, 200)
+        return response.json()["reply"]
+
+    def test_retried_confirmation_creates_one_booking(self):
+        self.start_confirmation(self.client)
+
+        first_reply = self.confirm(self.client, "key-1")
+        retried_reply = self.confirm(self.client, "key-1")
+
+        self.assertEqual(first_reply, retried_reply)
+        self.assertEqual(Appointment.objects.count(), 1)
+        self.assertIn(Appointment.objects.get().reference_number, first_reply)
+
+    def test_retry_after_cache_loss_reuses_booking(self):
+        self.start_confirmation(self.client)
+        first_reply = self.confirm(self.client, "key-1")
+
+        # Lose the cached reply and replay the same confirmation step
+        cache.clear()
+        views.user_sessions[self.client.session.session_key]["state"] = "confirm_slot"
+        retried_reply = self.confirm(self.client, "key-1")
+
+        self.assertEqual(first_reply, retried_reply)
+        self.assertEqual(Appointment.objects.count(), 1)
+
+    def test_same_key_from_another_session_books_separately(self):
+        other_client = self.client_class()
+        self.start_confirmation(self.client)
+        self.start_confirmation(other_client)
+
+        first_reply = self.confirm(self.client, "key-1")
+        other_reply = self.confirm(other_client, "key-1")
+
+        self.assertNotEqual(first_reply, other_reply)
+        self.assertEqual(Appointment.objects.count(), 2)
+
+    @override_settings(BOOKING_WRITE_BEHIND=True)
+    def test_retry_while_booking_is_journaled_keeps_the_reference(self):
+        self.start_confirmation(self.client)
+        with mock.patch("chatbot.views.get_booking_journal") as get_booking_journal:
+            first_reply = self.confirm(self.client, "key-1")
+
+            # The booking hasn't reached the database yet; lose the cached reply and retry
+            cache.clear()
+            views.user_sessions[self.client.session.session_key]["state"] = "confirm_slot"
+            retried_reply = self.confirm(self.client, "key-1")
+
+        self.assertEqual(first_reply, retried_reply)
+        submitted = [call.args[0]["appointment"]["reference_number"] for call in get_booking_journal().submit.call_args_list]
+        self.assertEqual(len(set(submitted)), 1)
+
+
+class LoadSheddingTests(TestCase):
+    databases = {"default", "cache"}
+
+    def setUp(self):
+        limits_cache.clear()
+
+    def record_slow_calls(self, count, finished):
+        limits_cache.set(ratelimit.LLM_STATE_KEY, {**ratelimit.llm_state(), "latencies": [(finished, 30.0)] * count}, None)
+
+    def test_sheds_on_slow_calls_but_lets_a_probe_through(self):
+        self.record_slow_calls(ratelimit.MIN_LATENCY_SAMPLES, time.time())
+
+        ratelimit.check_rate_limits("127.0.0.1", "session-1", calls_llm=True)
+        with self.assertRaises(ratelimit.Throttled) as raised:
+            ratelimit.check_rate_limits("127.0.0.1", "session-2", calls_llm=True)
+        self.assertEqual(raised.exception.status, 503)
+
+    def test_old_latency_samples_stop_shedding(self):
+        self.record_slow_calls(ratelimit.MIN_LATENCY_SAMPLES, time.time() - ratelimit.LATENCY_WINDOW - 1)
+
+        self.assertIsNone(ratelimit.llm_p95_latency())
+        ratelimit.check_rate_limits("127.0.0.1", "session-1", calls_llm=True)
+
+    def test_calls_from_dead_workers_expire(self):
+        started = time.time() - ratelimit.LLM_CALL_TIMEOUT - 1
+        calls = {f"call-{i}": started for i in range(ratelimit.MAX_LLM_IN_FLIGHT)}
+        limits_cache.set(ratelimit.LLM_STATE_KEY, {**ratelimit.llm_state(), "calls": calls}, None)
+
+        self.assertEqual(ratelimit.llm_in_flight(), 0)
+
+    def test_llm_call_updates_shared_state_once_per_edge(self):
+        with mock.patch("chatbot.ratelimit.update_state", wraps=ratelimit.update_state) as update_state:
+            with ratelimit.track_llm_call() as call:
+                self.assertEqual(ratelimit.llm_in_flight(), 1)
+                call["record_usage"] = lambda usage, latency: record_usage(usage, "follow_up", 100, 10, latency)
+
+        self.assertEqual(update_state.call_count, 2)
+        self.assertEqual(ratelimit.llm_in_flight(), 0)
+        self.assertEqual(len(ratelimit.llm_state()["latencies"]), 1)
+        self.assertEqual(usage_by_call_site()["follow_up"]["calls"], 1)
+
+
+def journal_record(reference_number, idempotency_key=None):
+    return {
+        "patient": {"name": "Jane Doe", "age": 45, "gender": "female", "medical_history": ""},
+        "appointment": {
+            "package_id": "PKG003",
+            "package_name": "Basic Checkup",
+            "hospital_name": "City General Hospital",
+            "appointment_date": "2025-10-01",
+            "appointment_time": "09:00",
+            "reference_number": reference_number,
+            "idempotency_key": idempotency_key,
+        },
+    }
+
+
+class JournalReplayTests(TestCase):
+    def setUp(self):
+        self.directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, self.directory)
+
+    def write_journal(self, name, records):
+        with open(self.directory / name, "w", encoding="utf-8") as journal_file:
+            for record in records:
+                journal_file.write(json.dumps(record) + "\n")
+
+    def test_replaying_twice_inserts_each_booking_once(self):
+        self.write_journal("bookings-1-1.jsonl", [journal_record("CHK1"), journal_record("CHK2"), journal_record("CHK1")])
+        self.assertEqual(replay_journals(self.directory), (2, 0))
+
+        # Same bookings again, e.g. a journal that was replayed but not removed before a crash
+        self.write_journal("bookings-1-1.jsonl", [journal_record("CHK1"), journal_record("CHK2")])
+        self.assertEqual(replay_journals(self.directory), (0, 0))
+
+        self.assertEqual(Appointment.objects.count(), 2)
+        self.assertEqual(list(self.directory.glob("bookings-*.jsonl")), [])
+
+    def test_archived_booking_counts_as_written(self):
+        write_appointments([journal_record("CHK1")])
+        list(archive_batches(date(2026, 1, 1)))
+        self.write_journal("bookings-1-1.jsonl", [journal_record("CHK1")])
+
+        self.assertEqual(replay_journals(self.directory), (0, 0))
+        self.assertEqual(AllAppointment.objects.count(), 1)
+
+    def test_conflicting_booking_is_reported_not_dropped(self):
+        write_appointments([journal_record("CHK1", idempotency_key="key-1")])
+        self.write_journal("bookings-1-1.jsonl", [journal_record("CHK2", idempotency_key="key-1")])
+
+        self.assertEqual(replay_journals(self.directory), (0, 1))
+        conflicts = (self.directory / CONFLICTS_FILE).read_text().splitlines()
+        self.assertEqual(json.loads(conflicts[0])["appointment"]["reference_number"], "CHK2")
+
+
+class BookingJournalWriterTests(SimpleTestCase):
+    def test_failed_batch_is_retried_and_journal_truncated(self):
+        directory = Path(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, directory)
+        journal = BookingJournal(directory)
+
+        with mock.patch("chatbot.journal.commit_bookings", side_effect=[OperationalError("database is locked"), ([], [])]) as commit, \
+             mock.patch("chatbot.journal.time.sleep"), self.assertLogs("chatbot.journal", "ERROR"):
+            journal.submit(journal_record("CHK1"))
+            journal.flush()
+
+        self.assertEqual(commit.call_count, 2)
+        self.assertEqual(journal.path.stat().st_size, 0)
+
+
+class ProfilingTests(TestCase):
+    databases = {"default", "cache"}
+
+    def test_failed_profile_write_keeps_the_reply(self):
+        unwritable = tempfile.NamedTemporaryFile()
+        self.addCleanup(unwritable.close)
+
+        # A file where the profile directory should be makes every write fail
+        with override_settings(CHATBOT_PROFILE_SAMPLE_RATE=1, CHATBOT_PROFILE_DIR=Path(unwritable.name)), \
+             self.assertLogs("chatbot.profiling", "ERROR"):
+            response = self.client.post(CHAT_URL, {"message": "hi"}, content_type="application/json")
+
+        self.assertEqual(response.status_code, 200)
+        self.assertNotIn("X-Chatbot-Profile-Id", response)
+
+    @override_settings(CHATBOT_SIGNING_KEY=None)
+    def test_header_is_ignored_without_signing_key(self):
+        request = RequestFactory().post(CHAT_URL, headers={PROFILE_HEADER: "profile:anything"})
+        self.assertIsNone(profile_trigger(request))
+
+
+class ExportTokenTests(TestCase):
+    url = "/api/exports/City General Hospital/appointments.csv"
+
+    def export(self, token):
+        return self.client.get(self.url, headers={"Authorization": f"Bearer {token}"})
+
+    def test_export_refused_until_a_token_is_issued(self):
+        self.assertEqual(self.export("").status_code, 403)
+
+        token = issue_export_token("City General Hospital")
+        self.assertEqual(self.export(token).status_code, 200)
+        self.assertEqual(self.export(token[:-1]).status_code, 403)
+
+    def test_token_is_scoped_to_its_hospital(self):
+        token = issue_export_token("Apollo Hospital")
+        self.assertEqual(self.export(token).status_code, 403)
+
+
+class ExportFeedTests(TestCase):
+    url = "/api/exports/City General Hospital/appointments.csv"
+
+    def setUp(self):
+        self.token = issue_export_token("City General Hospital")
+        patient = Patient.objects.create(name="Jane Doe", age=45, gender="female")
+        self.appointments = [
+            Appointment.objects.create(
+                patient=patient, package_id="PKG003", package_name="Basic Checkup", hospital_name="City General Hospital",
+                appointment_date=appointment_date, appointment_time="09:00", reference_number=f"CHK{i}",
+            )
+            for i, appointment_date in enumerate([date(2020, 1, 1), date(2099, 1, 1)])
+        ]
+
+    def export(self, since="", etag=""):
+        headers = {"Authorization": f"Bearer {self.token}", "If-None-Match": etag}
+        response = self.client.get(self.url, {"since": since}, headers=headers)
+        body = b"".join(response.streaming_content).decode() if response.streaming else ""
+        return response, body.splitlines()[1:]
+
+    def test_export_includes_archived_appointments(self):
+        list(archive_batches(date(2025, 1, 1)))
+
+        response, rows = self.export()
+        self.assertEqual([row.split(",")[1] for row in rows], ["CHK0", "CHK1"])
+
+    def test_cancellation_changes_etag_and_shows_up_after_the_cursor(self):
+        response, rows = self.export()
+        etag, cursor = response["ETag"], response["X-Next-Cursor"]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual(self.export(etag=etag)[0].status_code, 304)
+
+        cancelled = self.appointments[0]
+        cancelled.status = "cancelled"
+        cancelled.save()
+
+        self.assertEqual(self.export(etag=etag)[0].status_code, 200)
+        _, rows = self.export(since=cursor)
+        self.assertEqual(len(rows), 1)
+        self.assertIn("CHK0", rows[0])
+        self.assertIn("cancelled", rows[0])
+
+    def test_out_of_range_cursor_is_a_bad_request(self):
+        for since in ("99999999999999999999999-1", "1-99999999999999999999999"):
+            with self.subTest(since=since):
+                self.assertEqual(self.export(since=since)[0].status_code, 400)
+
+    def test_unchanged_poll_is_a_few_index_lookups(self):
+        etag = self.export()[0]["ETag"]
+
+        # Export token, newest (updated_at, id), last deletion
+        with self.assertNumQueries(3):
+            self.assertEqual(self.export(etag=etag)[0].status_code, 304)
+
+    def test_deletion_in_the_admin_changes_etag(self):
+        etag = self.export()[0]["ETag"]
+
+        AppointmentAdmin(Appointment, admin.site).delete_queryset(None, Appointment.objects.filter(pk=self.appointments[0].pk))
+
+        response, rows = self.export(etag=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(rows), 1)
+
+
+SLOTS_REPLY = {
+    "type": "slots",
+    "text": "No slots available on 2025-10-01. Here are some alternatives:",
+    "rows": [{"index": 1, "hospital_name": "<b>Apex</b> Medical", "date": "2025-10-02", "time_slot": "09:30"}],
+    "footer": "Please select an option by number (e.g., '1') or by mentioning the hospital/date.",
+}
+
+
+class ReplyPayloadTests(TestCase):
+    databases = {"default", "cache"}
+
+    def setUp(self):
+        cache.clear()
+
+    def test_slots_are_sent_as_typed_json(self):
+        payload = views.build_reply_payload(SLOTS_REPLY)
+
+        self.assertEqual(payload["type"], "slots")
+        self.assertEqual(payload["text"], SLOTS_REPLY["text"])
+        self.assertEqual(payload["rows"], SLOTS_REPLY["rows"])
+
+    def test_packages_are_sent_as_typed_json(self):
+        response = self.client.post(CHAT_URL, {"message": "list packages"}, content_type="application/json")
+
+        payload = response.json()
+        self.assertEqual(payload["type"], "packages")
+        self.assertTrue(payload["text"])
+        self.assertEqual(set(payload["rows"][0]), {"package_name", "tests_included"})
+
+    def test_html_format_keeps_escaped_table(self):
+        html = views.build_reply_payload(SLOTS_REPLY, "html")["reply"]
+
+        self.assertIn("<table", html)
+        self.assertIn("&lt;b&gt;Apex&lt;/b&gt; Medical", html)
+        self.assertNotIn("<b>Apex", html)
+
+    def test_html_format_over_the_api(self):
+        response = self.client.post(CHAT_URL, {"message": "list packages", "format": "html"}, content_type="application/json")
+
+        self.assertIn("<table", response.json()["reply"])
+        self.assertNotIn("type", response.json())
+
+
+class CompressionMiddlewareTests(SimpleTestCase):
+    body = "Checkup packages " * 50
+
+    def compress(self, response):
+        request = RequestFactory().get("/", headers={"Accept-Encoding": "gzip, deflate, br"})
+        with mock.patch("chatbot.middleware.brotli") as brotli:
+            brotli.compress.return_value = b"compressed"
+            response = CompressionMiddleware(lambda request: response)(request)
+        return response, brotli
+
+    def test_json_is_brotli_encoded(self):
+        response, brotli = self.compress(JsonResponse({"reply": self.body}))
+
+        self.assertEqual(response["Content-Encoding"], "br")
+        self.assertEqual(response.content, b"compressed")
+        brotli.compress.assert_called_once()
+
+    def test_html_stays_on_padded_gzip(self):
+        response, brotli = self.compress(HttpResponse(f"<p>{self.body}</p>"))
+
+        self.assertEqual(response["Content-Encoding"], "gzip")
+        brotli.compress.assert_not_called()
+
+
+ALTERNATIVES = [
+    {"hospital_name": "Apex Medical", "appointment_date": date(2025, 9, 1), "time_slot": "09:30", "package_id": "PKG003", "package_name": "Basic Checkup"},
+    {"hospital_name": "Metro Health", "appointment_date": date(2025, 9, 2), "time_slot": "11:00", "package_id": "PKG003", "package_name": "Basic Checkup"},
+]
+
+
+class PromptTests(SimpleTestCase):
+    def test_long_message_is_truncated_to_the_token_budget(self):
+        prompt = render_prompt("collect_details", "Jane Doe, 45, female. " * 500)
+
+        self.assertLessEqual(estimate_tokens(prompt), PROMPTS["collect_details"]["max_input_tokens"])
+        self.assertIn("Jane Doe, 45, female.", prompt)
+
+    def test_slot_options_are_compact_numbered_codes(self):
+        options = format_slot_options(ALTERNATIVES)
+
+        self.assertEqual(options, "1. Apex Medical 2025-09-01 09:30\n2. Metro Health 2025-09-02 11:00")
+        self.assertNotIn("datetime.date(", options)
+
+    def test_record_usage_accumulates_per_call_site(self):
+        usage = record_usage({}, "follow_up", 100, 10, 0.5)
+        usage = record_usage(usage, "follow_up", 50, 5, 0.25)
+        usage = record_usage(usage, "collect_details", 200, 40, 1.0)
+
+        self.assertEqual(usage["follow_up"], {"calls": 2, "input_tokens": 150, "output_tokens": 15, "latency": 0.75})
+        self.assertEqual(usage["collect_details"]["calls"], 1)
+
+
+class AlternativeSelectionTests(SimpleTestCase):
+    def select(self, gemini_reply):
+        session = {"state": "select_alternative_slot", "patient_data": {}, "alternative_slots": [dict(alt) for alt in ALTERNATIVES]}
+        with mock.patch("chatbot.views.generate_text", return_value=gemini_reply) as generate_text:
+            views.process_user_message("the one at metro health", session)
+        generate_text.assert_called_once()
+        return session
+
+    def test_number_reply_selects_that_option(self):
+        for gemini_reply in ("2", "Option 2"):
+            with self.subTest(gemini_reply=gemini_reply):
+                session = self.select(gemini_reply)
+                self.assertEqual(session["state"], "confirm_slot")
+                self.assertEqual(session["patient_data"]["selected_hospital"], "Metro Health")
+
+    def test_na_reply_selects_nothing(self):
+        session = self.select("N/A")
+
+        self.assertEqual(session["state"], "select_alternative_slot")
+        self.assertNotIn("selected_hospital", session["patient_data"])
+
+
+class ArchiveTests(TestCase):
+    cutoff = date(2025, 1, 1)
+
+    def setUp(self):
+        self.patient = Patient.objects.create(name="Jane Doe", age=45, gender="female")
+
+    def book(self, reference_number, appointment_date, status="confirmed"):
+        return Appointment.objects.create(
+            patient=self.patient, package_id="PKG003", package_name="Basic Checkup", hospital_name="City General Hospital",
+            appointment_date=appointment_date, appointment_time="09:00", reference_number=reference_number, status=status,
+        )
+
+    def test_rerun_after_interruption_finishes_then_is_a_no_op(self):
+        for i in range(3):
+            self.book(f"CHK{i}", date(2024, 1, i + 1))
+
+        batches = archive_batches(self.cutoff, batch_size=1)
+        next(batches)
+        batches.close() # Interrupted after the first batch
+
+        self.assertEqual(list(archive_batches(self.cutoff, batch_size=1)), [1, 1])
+        self.assertEqual(list(archive_batches(self.cutoff, batch_size=1)), [])
+        self.assertEqual(ArchivedAppointment.objects.count(), 3)
+        self.assertFalse(Appointment.objects.exists())
+
+    def test_cancelled_future_appointment_is_archived(self):
+        self.book("CHK1", date(2099, 1, 1), status="cancelled")
+        upcoming = self.book("CHK2", date(2099, 1, 1))
+
+        self.assertEqual(list(archive_batches(self.cutoff)), [1])
+        self.assertEqual(list(Appointment.objects.all()), [upcoming])
+        self.assertEqual(ArchivedAppointment.objects.get().reference_number, "CHK1")
+
+    def test_all_appointments_reports_is_archived(self):
+        self.book("CHK1", date(2024, 1, 1))
+        self.book("CHK2", date(2099, 1, 1))
+        list(archive_batches(self.cutoff))
+
+        self.assertEqual(
+            dict(AllAppointment.objects.values_list("reference_number", "is_archived")),
+            {"CHK1": True, "CHK2": False},
+        )
+
+    def test_conflict_with_the_archive_keeps_the_hot_row(self):
+        self.book("CHK1", date(2024, 1, 1))
+        list(archive_batches(self.cutoff))
+        self.book("CHK1", date(2024, 1, 2)) # Same reference number as the archived row
+
+        with self.assertRaises(IntegrityError):
+            list(archive_batches(self.cutoff))
+        self.assertEqual(Appointment.objects.count(), 1)
+
+
+class ExportFormatTests(SimpleTestCase):
+    def test_csv_neutralizes_formula_cells(self):
+        rows = [(1, "CHK1", "=HYPERLINK(\"http://x\")", "+1", "-2", "@SUM(A1)", "Jane", 45)]
+
+        body = "".join(stream_csv(rows)).splitlines()[1]
+        self.assertEqual(body, "1,CHK1,\"'=HYPERLINK(\"\"http://x\"\")\",'+1,'-2,'@SUM(A1),Jane,45")
+
+    def test_ics_lines_fold_at_75_octets(self):
+        folded = ics_line("SUMMARY:" + "Ünïcödé Checkup " * 20)
+
+        lines = folded.split("\r\n")[:-1]
+        self.assertGreater(len(lines), 1)
+        self.assertTrue(all(len(line.encode()) <= 75 for line in lines))
+        self.assertTrue(all(line.startswith(" ") for line in lines[1:]))
+        self.assertEqual("".join(line[1:] if i else line for i, line in enumerate(lines)), "SUMMARY:" + "Ünïcödé Checkup " * 20)
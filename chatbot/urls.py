@@ -3,5 +3,8 @@ from . import views
 
 urlpatterns = [
     path('chat/', views.chatbot_api, name='chatbot_api'),
+    path('metrics/', views.chatbot_metrics, name='chatbot_metrics'),
+    path('exports/<str:hospital_name>/appointments.csv', views.export_appointments, {'export_format': 'csv'}, name='export_appointments_csv'),
+    path('exports/<str:hospital_name>/appointments.ics', views.export_appointments, {'export_format': 'ics'}, name='export_appointments_ics'),
     path('', views.chat_interface, name='chat_interface'), # For the frontend
 ]
@@ -1,8 +1,12 @@
 import google.generativeai as genai
 from django.conf import settings
-from django.http import JsonResponse
+from django.contrib.admin.views.decorators import staff_member_required
+from django.core.cache import cache
+from django.http import JsonResponse, StreamingHttpResponse
+from django.utils.cache import get_conditional_response
 from django.views.decorators.csrf import csrf_exempt
 import json
+import math
 import re
 from datetime import datetime, timedelta
 import uuid # For generating unique reference numbers
@@ -10,8 +14,14 @@ from django.shortcuts import render
 
 import pandas as pd
 
+from .concurrency import IDEMPOTENCY_TTL, SessionBusy, idempotency_cache_key, scoped_idempotency_key, session_lock, single_flight
+from .exports import check_export_token, export_queryset, export_snapshot, format_cursor, iter_appointment_rows, parse_cursor, stream_csv, stream_ics
+from .journal import get_booking_journal, write_appointments
+from .profiling import profile_request
+from .prompts import PROMPTS, estimate_tokens, format_slot_options, record_usage, render_prompt, usage_by_call_site
+from .ratelimit import Throttled, check_rate_limits, llm_in_flight, llm_p95_latency, rejection_counts, track_llm_call
 from .utils import load_checkups_data
-from .models import Patient, Appointment # If you decide to use models
+from .models import AllAppointment # If you decide to use models
 
 # Configure Gemini API
 genai.configure(api_key=settings.GEMINI_API_KEY)
@@ -21,31 +31,106 @@ model = genai.GenerativeModel('gemini-1.5-flash')
 user_sessions = {}
 
 @csrf_exempt
+@profile_request
 def chatbot_api(request):
     if request.method == "POST":
         try:
             data = json.loads(request.body)
             user_message = data.get("message", "").strip()
+            reply_format = data.get("format", "json")
+            idempotency_key = request.headers.get("Idempotency-Key")
             session_id = request.session.session_key
             if not session_id:
                 request.session.save()
                 session_id = request.session.session_key
 
-            if session_id not in user_sessions:
-                user_sessions[session_id] = {"state": "initial", "patient_data": {}}
-
-            session = user_sessions[session_id]
-
-            bot_reply = process_user_message(user_message, session)
-            return JsonResponse({"reply": bot_reply})
+            # A retried request with a key we've already answered gets the same reply back
+            if idempotency_key:
+                payload = cache.get(idempotency_cache_key(session_id, idempotency_key))
+                if payload is not None:
+                    return JsonResponse(payload)
+
+            calls_llm = may_call_llm(user_message, user_sessions.get(session_id, {}))
+            check_rate_limits(request.META.get("REMOTE_ADDR", ""), session_id, calls_llm)
+
+            def handle_message():
+                with session_lock(session_id):
+                    if idempotency_key:
+                        payload = cache.get(idempotency_cache_key(session_id, idempotency_key))
+                        if payload is not None:
+                            return payload
+
+                    if session_id not in user_sessions:
+                        user_sessions[session_id] = {"state": "initial", "patient_data": {}}
+
+                    session = user_sessions[session_id]
+
+                    bot_reply = process_user_message(
+                        user_message,
+                        session,
+                        idempotency_key=scoped_idempotency_key(session_id, idempotency_key) if idempotency_key else None,
+                    )
+                    payload = build_reply_payload(bot_reply, reply_format)
+                    if idempotency_key:
+                        cache.set(idempotency_cache_key(session_id, idempotency_key), payload, IDEMPOTENCY_TTL)
+                    return payload
+
+            payload = single_flight(session_id, f"{reply_format}:{user_message}", handle_message)
+            return JsonResponse(payload)
         except json.JSONDecodeError:
             return JsonResponse({"reply": "Invalid JSON format."}, status=400)
+        except SessionBusy:
+            return retry_later_response("Your previous message is still being processed. Please try again.", 409, 1)
+        except Throttled as e:
+            if e.status == 503:
+                return retry_later_response("We're handling a lot of requests right now. Please try again shortly.", 503, e.retry_after)
+            return retry_later_response("You're sending messages too quickly. Please wait a moment.", 429, e.retry_after)
         except Exception as e:
             return JsonResponse({"reply": f"An error occurred: {str(e)}"}, status=500)
     return JsonResponse({"reply": "Method not allowed."}, status=405)
 
 
-def process_user_message(message, session):
+@staff_member_required
+def chatbot_metrics(request):
+    return JsonResponse({
+        "rejections": rejection_counts(),
+        "llm_in_flight": llm_in_flight(),
+        "llm_p95_latency": llm_p95_latency(),
+        "llm_usage": usage_by_call_site(),
+    })
+
+def retry_later_response(message, status, retry_after):
+    response = JsonResponse({"reply": message}, status=status)
+    response["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return response
+
+def generate_text(call_site, prompt):
+    with track_llm_call() as call:
+        response = model.generate_content(
+            prompt,
+            generation_config={"max_output_tokens": PROMPTS[call_site]["max_output_tokens"]},
+        )
+        text = response.text.strip()
+
+        # Prefer Gemini's own counts; fall back to our estimate if they're missing
+        usage = getattr(response, "usage_metadata", None)
+        input_tokens = getattr(usage, "prompt_token_count", None) or estimate_tokens(prompt)
+        output_tokens = getattr(usage, "candidates_token_count", None) or estimate_tokens(text)
+        call["record_usage"] = lambda totals, latency: record_usage(totals, call_site, input_tokens, output_tokens, latency)
+    return text
+
+def may_call_llm(message, session):
+    # Mirrors the branches in process_user_message that call Gemini
+    lowered = message.lower()
+    if "follow-up" in lowered or "recurring" in lowered:
+        return True
+    state = session.get("state", "initial")
+    if state == "collect_details":
+        return True
+    return state == "select_alternative_slot" and not re.match(r'^\s*(\d+)\s*$', message)
+
+
+def process_user_message(message, session, idempotency_key=None):
     state = session.get("state", "initial")
     patient_data = session.get("patient_data", {})
     checkups_df = load_checkups_data()
@@ -53,8 +138,7 @@ def process_user_message(message, session):
      # Complex Use Case: Recurring Checkups
     if "follow-up" in message.lower() or "recurring" in message.lower():
         # This would require more sophisticated NLP to extract recurrence interval
-        prompt = f"Extract the follow-up interval (e.g., 6 months, 1 year) from: '{message}'"
-        gemini_response = model.generate_content(prompt).text.strip()
+        gemini_response = generate_text("follow_up", render_prompt("follow_up", message))
         interval_match = re.search(r"(\d+)\s*(month|year)s?", gemini_response, re.IGNORECASE)
 
         if interval_match:
@@ -71,7 +155,7 @@ def process_user_message(message, session):
             patient_data["recurrence_interval"] = f"{num} {unit}s"
             session["patient_data"] = patient_data
             session["state"] = "confirm_slot" # Re-use slot confirmation flow
-            return f"For a follow-up on {follow_up_date.strftime('%Y-%m-%d')}, I'll check availability. " + display_available_slots(patient_data, checkups_df, session)
+            return prefix_reply(f"For a follow-up on {follow_up_date.strftime('%Y-%m-%d')}, I'll check availability. ", display_available_slots(patient_data, checkups_df, session))
         else:
             return "For recurring checkups, please specify the interval (e.g., 'in 6 months', 'annually')."
 
@@ -87,13 +171,7 @@ def process_user_message(message, session):
             return "Welcome to the Health Checkup Scheduling Bot! Do you want to schedule a checkup or view available packages?"
 
     elif state == "collect_details":
-        prompt = (
-            f"From the following text, extract the Name, Age, Gender, and Medical History. "
-            f"Format your output as a markdown list, like: '* **Name:** [name]\\n* **Age:** [age]...'. "
-            f"If any piece of information is missing, use 'N/A' for that specific field.\n"
-            f"Text: '{message}'"
-        )
-        gemini_response = model.generate_content(prompt).text.strip()
+        gemini_response = generate_text("collect_details", render_prompt("collect_details", message))
         print(f"Gemini Raw Response: {gemini_response}") # Keep for continued debugging
 
         # --- UPDATED REGEX PATTERNS TO MATCH MARKDOWN LIST ---
@@ -152,39 +230,16 @@ def process_user_message(message, session):
             if 0 <= index < len(alternatives):
                 selected_alternative = alternatives[index]
         else:
-            # Try to parse by text (hospital name, date part, time part)
-            # Use Gemini to extract the selected alternative details
-            prompt = (
-                f"From the alternatives provided: {', '.join([str(alt) for alt in alternatives])}\n"
-                f"Identify the hospital, date (YYYY-MM-DD), and time (HH:MM IST) selected in the user's message: '{message}'. "
-                f"Format as: Hospital: [hospital_name], Date: [date], Time: [time]. If uncertain, state N/A."
-            )
-            gemini_response = model.generate_content(prompt).text.strip()
+            # Let Gemini map free text (hospital name, date, time) onto one of the numbered options
+            prompt = render_prompt("select_alternative", message, options=format_slot_options(alternatives))
+            gemini_response = generate_text("select_alternative", prompt)
             print(f"Gemini Alternative Selection Response: {gemini_response}") # Debug Gemini's output
 
-            # Regex to parse Gemini's structured response for selection
-            hospital_match = re.search(r"Hospital:\s*(.*?)(?:,|$)", gemini_response, re.IGNORECASE)
-            date_match = re.search(r"Date:\s*(\d{4}-\d{2}-\d{2})", gemini_response, re.IGNORECASE)
-            time_match = re.search(r"Time:\s*(\d{2}:\d{2}\s*IST)", gemini_response, re.IGNORECASE)
-
-            extracted_hospital = hospital_match.group(1).strip() if hospital_match else None
-            extracted_date_str = date_match.group(1).strip() if date_match else None
-            extracted_time = time_match.group(1).strip() if time_match else None
-
-            # Attempt to match extracted details to one of the stored alternatives
-            if extracted_hospital and extracted_date_str and extracted_time:
-                try:
-                    extracted_date = datetime.strptime(extracted_date_str, '%Y-%m-%d').date()
-                    for alt in alternatives:
-                        # Compare extracted details with stored alternatives
-                        if alt["hospital_name"].lower() == extracted_hospital.lower() and \
-                           alt["appointment_date"] == extracted_date and \
-                           alt["time_slot"].lower() == extracted_time.replace("IST", "").strip().lower(): # Match time more flexibly
-                            selected_alternative = alt
-                            break
-                except ValueError:
-                    # Date parsing failed, means Gemini might have given a bad date or it's not a date
-                    print(f"DEBUG: Failed to parse extracted date string: {extracted_date_str}")
+            choice_match = re.search(r"\d+", gemini_response)
+            if choice_match:
+                index = int(choice_match.group()) - 1
+                if 0 <= index < len(alternatives):
+                    selected_alternative = alternatives[index]
 
 
         if selected_alternative:
@@ -228,24 +283,37 @@ def process_user_message(message, session):
                     session["state"] = "initial"
                     return "Something went wrong with the appointment details. Please start over."
 
-                ref_number = generate_reference_number()
-
-                # Save appointment (if using Django models)
-                patient, created = Patient.objects.get_or_create(
-                    name=patient_data['name'],
-                    age=patient_data['age'],
-                    gender=patient_data['gender'],
-                    defaults={'medical_history': patient_data['medical_history']}
-                )
-                Appointment.objects.create(
-                    patient=patient,
-                    package_id=patient_data.get("recommended_package_id"),
-                    package_name=package_name,
-                    hospital_name=hospital_name,
-                    appointment_date=appointment_date,
-                    appointment_time=time_slot,
-                    reference_number=ref_number
-                )
+                # The same confirmation retried (e.g. after a dropped response) reuses the original booking
+                if idempotency_key:
+                    existing = AllAppointment.objects.filter(idempotency_key=idempotency_key).only("reference_number").first()
+                    if existing:
+                        session["state"] = "initial"
+                        return f"Checkup confirmed! Reference number: {existing.reference_number}. Anything else?"
+
+                ref_number = generate_reference_number(idempotency_key)
+
+                booking = {
+                    "patient": {
+                        "name": patient_data['name'],
+                        "age": patient_data['age'],
+                        "gender": patient_data['gender'],
+                        "medical_history": patient_data['medical_history'],
+                    },
+                    "appointment": {
+                        "package_id": patient_data.get("recommended_package_id"),
+                        "package_name": package_name,
+                        "hospital_name": hospital_name,
+                        "appointment_date": appointment_date,
+                        "appointment_time": time_slot,
+                        "reference_number": ref_number,
+                        "idempotency_key": idempotency_key or None,
+                    },
+                }
+                # Save appointment, either now or via the write-behind journal
+                if settings.BOOKING_WRITE_BEHIND:
+                    get_booking_journal().submit(booking)
+                else:
+                    write_appointments([booking])
 
                 session["state"] = "initial" # Reset state after confirmation
                 return f"Checkup confirmed! Reference number: {ref_number}. Anything else?"
@@ -264,13 +332,12 @@ def process_user_message(message, session):
 #     return f"Here are some of our available packages:\n{packages}"
 
 def display_available_packages(df):
-    packages_html = df[['package_name', 'tests_included']].drop_duplicates().to_html(
-        index=False, 
-        classes='table table-bordered table-hover',  # Add Bootstrap styling
-        escape=False, 
-        border=0
-    )
-    return f"<h4>Here are some of our available packages:</h4>{packages_html}"
+    packages = df[['package_name', 'tests_included']].drop_duplicates()
+    return {
+        "type": "packages",
+        "text": "Here are some of our available packages:",
+        "rows": packages.to_dict("records"),
+    }
 
 def recommend_checkup_package(patient_data, df):
     age = patient_data["age"]
@@ -416,35 +483,16 @@ def display_available_slots(patient_data, df, current_session_data):
         ].sort_values(by='date').head(5) # Get up to 5 alternatives (consistent with previous full solution)
 
         if not alternative_slots_df.empty:
-            # alt_info = []
-            # current_session_data["alternative_slots"] = []
-
-            # for i, row in alternative_slots_df.iterrows():
-            #     alt_str = f"{i+1}. {row['hospital_name']} on {row['date'].strftime('%Y-%m-%d')} {row['time_slot']} IST"
-            #     alt_info.append(alt_str)
-            #     current_session_data["alternative_slots"].append({
-            #         "hospital_name": row['hospital_name'],
-            #         # CRITICAL: Always store as a pure date object
-            #         "appointment_date": row['date'].date(),
-            #         "time_slot": row['time_slot'],
-            #         "package_id": row['package_id'],
-            #         "package_name": patient_data.get("recommended_package_name")
-            #     })
-            from django.utils.html import escape  # Optional for extra safety
-
-            # Prepare HTML table for alternatives
-            alt_table_rows = []
+            alt_rows = []
             current_session_data["alternative_slots"] = []
 
             for i, (_, row) in enumerate(alternative_slots_df.iterrows(), start=1):
-                alt_table_rows.append(f"""
-                    <tr>
-                        <td>{i}</td>
-                        <td>{escape(row['hospital_name'])}</td>
-                        <td>{row['date'].strftime('%Y-%m-%d')}</td>
-                        <td>{row['time_slot']} IST</td>
-                    </tr>
-                """)
+                alt_rows.append({
+                    "index": i,
+                    "hospital_name": row['hospital_name'],
+                    "date": row['date'].strftime('%Y-%m-%d'),
+                    "time_slot": row['time_slot'],
+                })
                 current_session_data["alternative_slots"].append({
                     "hospital_name": row['hospital_name'],
                     "appointment_date": row['date'].date(),
@@ -453,37 +501,106 @@ def display_available_slots(patient_data, df, current_session_data):
                     "package_name": patient_data.get("recommended_package_name")
                 })
 
-            alt_table_html = f"""
-                <h4>No slots available on {preferred_date.strftime('%Y-%m-%d')}. Here are some alternatives:</h4>
-                <table class='table table-bordered table-hover'>
-                    <thead>
-                        <tr>
-                            <th>#</th>
-                            <th>Hospital</th>
-                            <th>Date</th>
-                            <th>Time Slot</th>
-                        </tr>
-                    </thead>
-                    <tbody>
-                        {''.join(alt_table_rows)}
-                    </tbody>
-                </table>
-                <p>Please select an option by number (e.g., '1') or by mentioning the hospital/date.</p>
-            """
-
             current_session_data["state"] = "select_alternative_slot"
-            return alt_table_html
-            
-            # current_session_data["state"] = "select_alternative_slot"
-            # return f"No slots available on {preferred_date.strftime('%Y-%m-%d')}. However, here are some alternatives:\n" + "\n".join(alt_info) + "\nPlease select an option by number (e.g., '1') or by mentioning the hospital/date."
-        
+            return {
+                "type": "slots",
+                "text": f"No slots available on {preferred_date.strftime('%Y-%m-%d')}. Here are some alternatives:",
+                "rows": alt_rows,
+                "footer": "Please select an option by number (e.g., '1') or by mentioning the hospital/date.",
+            }
+
         else:
             current_session_data["state"] = "initial"
             return "Sorry, no immediate slots or alternatives are available for that package. Please try a different package or contact the hospital directly."
 
-def generate_reference_number():
+def prefix_reply(prefix, reply):
+    # Structured replies keep their rows; only the lead-in text changes
+    if isinstance(reply, dict):
+        return {**reply, "text": prefix + reply["text"]}
+    return prefix + reply
+
+def build_reply_payload(reply, reply_format="json"):
+    """
+    Turn a reply from process_user_message into the API response body.
+
+    Plain strings become {"type": "text", "reply": ...}. Structured replies
+    (slots, packages) are sent as typed JSON for the front end to render;
+    reply_format="html" keeps the old server-rendered table in "reply" for
+    clients that still inject it via innerHTML.
+    """
+    if not isinstance(reply, dict):
+        if reply_format == "html":
+            return {"reply": reply}
+        return {"type": "text", "reply": reply}
+
+    if reply_format == "html":
+        return {"reply": render_reply_html(reply)}
+    return {**reply, "reply": reply["text"]}
+
+def render_reply_html(reply):
+    from django.utils.html import escape
+
+    if reply["type"] == "packages":
+        header_cells = "<th>package_name</th><th>tests_included</th>"
+        body_rows = [
+            f"<tr><td>{escape(row['package_name'])}</td><td>{escape(row['tests_included'])}</td></tr>"
+            for row in reply["rows"]
+        ]
+    else:
+        header_cells = "<th>#</th><th>Hospital</th><th>Date</th><th>Time Slot</th>"
+        body_rows = [
+            f"<tr><td>{row['index']}</td><td>{escape(row['hospital_name'])}</td>"
+            f"<td>{row['date']}</td><td>{escape(row['time_slot'])} IST</td></tr>"
+            for row in reply["rows"]
+        ]
+
+    footer = f"<p>{escape(reply['footer'])}</p>" if reply.get("footer") else ""
+    return (
+        f"<h4>{escape(reply['text'])}</h4>"
+        f"<table class='table table-bordered table-hover'>"
+        f"<thead><tr>{header_cells}</tr></thead>"
+        f"<tbody>{''.join(body_rows)}</tbody>"
+        f"</table>{footer}"
+    )
+
+def generate_reference_number(idempotency_key=None):
+    # A retried confirmation gets the first attempt's reference even while that
+    # booking is still in the write-behind journal, where the lookup can't see it;
+    # the journal writer then skips the repeat as already written
+    if idempotency_key:
+        return "CHK" + idempotency_key[:9].upper()
     return "CHK" + str(uuid.uuid4()).replace("-", "")[:9].upper() # Example simple reference
 
+def export_appointments(request, hospital_name, export_format):
+    if request.method != "GET":
+        return JsonResponse({"error": "Method not allowed."}, status=405)
+
+    token = request.headers.get("Authorization", "").removeprefix("Bearer ").strip()
+    if not check_export_token(hospital_name, token):
+        return JsonResponse({"error": "Invalid export token."}, status=403)
+
+    try:
+        since = parse_cursor(request.GET.get("since"))
+        on_date = datetime.strptime(request.GET["date"], "%Y-%m-%d").date() if "date" in request.GET else None
+    except ValueError:
+        return JsonResponse({"error": "'since' must be an X-Next-Cursor value and 'date' YYYY-MM-DD."}, status=400)
+
+    queryset = export_queryset(hospital_name, on_date)
+    upto, etag = export_snapshot(hospital_name, since)
+    not_modified = get_conditional_response(request, etag=f'"{etag}"')
+    if not_modified is not None:
+        return not_modified
+
+    rows = iter_appointment_rows(queryset, since, upto)
+    if export_format == "ics":
+        response = StreamingHttpResponse(stream_ics(rows, hospital_name), content_type="text/calendar; charset=utf-8")
+    else:
+        response = StreamingHttpResponse(stream_csv(rows), content_type="text/csv; charset=utf-8")
+    response["ETag"] = f'"{etag}"'
+    response["X-Next-Cursor"] = format_cursor(upto) # Pass back as ?since= to only get new or changed bookings
+    response["Content-Disposition"] = f'attachment; filename="appointments.{export_format}"'
+    return response
+
 def chat_interface(request):
     return render(request, 'chatbot/chat.html')
 
@@ -52,6 +52,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'chatbot.middleware.CompressionMiddleware', # gzip/brotli for API replies; keep above body-modifying middleware
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -85,9 +86,41 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
-    }
+        # Reuse connections across requests, checking they're still usable first
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            # WAL lets readers run alongside the single writer; NORMAL sync is safe with WAL
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            # Take the write lock at BEGIN so concurrent bookings queue on busy_timeout
+            # instead of failing with "database is locked" on lock upgrade
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 20, # Sets SQLite's busy timeout, in seconds
+        },
+    },
+    # Cache tables (see CACHES below) live in a separate file so their
+    # writes don't contend with bookings for the project database's write lock
+    'cache': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': BASE_DIR / 'cache.sqlite3',
+        'CONN_MAX_AGE': 600,
+        'CONN_HEALTH_CHECKS': True,
+        'OPTIONS': {
+            'init_command': 'PRAGMA journal_mode=WAL; PRAGMA synchronous=NORMAL;',
+            'transaction_mode': 'IMMEDIATE',
+            'timeout': 5,
+        },
+    },
 }
 
+DATABASE_ROUTERS = ['chatbot.routers.CacheRouter']
+
+# Write-behind booking journal: when enabled, confirmations are appended to a
+# durable journal and inserted in batches by a background thread. Replay any
+# journal left by a crash with `python manage.py replay_booking_journal`.
+BOOKING_WRITE_BEHIND = os.getenv('BOOKING_WRITE_BEHIND', '').lower() in ('1', 'true', 'yes')
+BOOKING_JOURNAL_DIR = BASE_DIR / 'booking_journal'
+
 # DATABASES = {
 #     'default': {
 #         'ENGINE': 'django.db.backends.postgresql',
@@ -99,6 +132,46 @@ DATABASES = {
 #     }
 # }
 
+# Cache
+# Session locks, in-flight markers and idempotency records are kept here. The
+# default is a table in the 'cache' database, so every worker process on the
+# host shares it and cache.add() is atomic across them; create the tables with
+# `python manage.py migrate --database cache`. CACHE_BACKEND/CACHE_LOCATION can
+# point it at e.g. Redis instead.
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', 'chatbot_cache'),
+        'OPTIONS': {
+            # Each chat message stores a 24h idempotency record
+            'MAX_ENTRIES': 100000,
+        },
+    },
+    # Rate limiter buckets and load/usage metrics, kept apart so idempotency
+    # records can't cull them. Set RATELIMIT_CACHE_LOCATION too when
+    # overriding CACHE_BACKEND.
+    'ratelimit': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.db.DatabaseCache'),
+        'LOCATION': os.getenv('RATELIMIT_CACHE_LOCATION', 'chatbot_ratelimit_cache'),
+        'KEY_PREFIX': 'ratelimit',
+        'OPTIONS': {
+            'MAX_ENTRIES': 100000,
+        },
+    },
+}
+
+# Request profiling for the chat API: send a signed X-Chatbot-Profile header
+# (see `python manage.py chatbot_profiles token`) or set a 1-in-N sample rate.
+# The header is signed with CHATBOT_SIGNING_KEY rather than SECRET_KEY, which is
+# committed to the repo; without it the header is ignored.
+CHATBOT_SIGNING_KEY = os.getenv('CHATBOT_SIGNING_KEY')
+CHATBOT_PROFILE_SAMPLE_RATE = int(os.getenv('CHATBOT_PROFILE_SAMPLE_RATE', '0')) # 0 disables sampling
+if CHATBOT_PROFILE_SAMPLE_RATE < 0:
+    raise ValueError("CHATBOT_PROFILE_SAMPLE_RATE must be 0 (disabled) or a positive 1-in-N rate.")
+CHATBOT_PROFILE_DIR = BASE_DIR / 'profiles'
+CHATBOT_PROFILE_KEEP = 50
+
 # Password validation
 # https://docs.djangoproject.com/en/5.2/ref/settings/#auth-password-validators
 